@@ -1,4 +1,4 @@
-from typing import List, Mapping, Dict, Any, cast, Tuple, Optional
+from typing import List, Mapping, Dict, Any, cast, Tuple, Optional, Union
 import sessions
 import webserver
 from PIL import Image
@@ -92,10 +92,18 @@ def store_account(id: str, _account: Account) -> None:
     assert id == _account.id, 'mismatching ids'
     db.put_account(id, _account.marshal())
 
-account_cache: cache.Cache[str,Account] = cache.Cache(300, fetch_account, store_account)
+def fetch_accounts(ids: List[str]) -> Mapping[str, Account]:
+    docs = db.get_accounts(ids)
+    return { id: Account.unmarshal(id, docs[id]) for id in docs }
 
+def store_accounts(items: List[Tuple[str, Account]]) -> None:
+    db.put_accounts([ (id, _account.marshal()) for id, _account in items ])
+
+account_cache: cache.Cache[str,Account] = cache.Cache(300, fetch_account, store_account, 'accounts', get_many_func=fetch_accounts, put_many_func=store_accounts)
+
+# (Names are only changed by make_starter_account and change_name, which both write through to the database,
+# so the database never has a stale name for an account in the cache.)
 def find_account_by_name(name: str) -> Account:
-    account_cache.flush()
     packet = db.get_account_by_name(name)
     if packet['_id'] in account_cache:
         return account_cache[packet['_id']]
@@ -110,7 +118,9 @@ def make_starter_account() -> Account:
     name = f'{auto_name_1[n1]} {auto_name_2[n2]} {auto_name_3[n3]}'
     image = f'starter_pics/{auto_name_2[n2]}.jpeg'
     account = Account(new_account_id(), name, image)
-    return account_cache.add(account.id, account)
+    account_cache.add(account.id, account)
+    account_cache.write_through(account.id) # so find_account_by_name can find it
+    return account
 
 def scrub_name(s: str) -> str:
     s = s[:100]
@@ -121,9 +131,7 @@ def scrub_name(s: str) -> str:
 
 
 # Load the account page
-with open('accounts.html') as f:
-    lines = f.readlines()
-    account_page = ''.join(lines)
+account_prefix, account_suffix = webserver.load_template('accounts.html')
 
 def do_ajax(ob: Mapping[str, Any], session: sessions.Session) -> Dict[str, Any]:
     try:
@@ -152,15 +160,14 @@ def do_ajax(ob: Mapping[str, Any], session: sessions.Session) -> Dict[str, Any]:
             newname = scrub_name(ob['name'])
             existing_account: Optional[Account] = None
             try:
-                existing_account = find_account_by_name(newname) # flushes accounts, so the account must be retrieved after this line
+                existing_account = find_account_by_name(newname)
             except KeyError:
                 pass
             if existing_account is None:
                 account = active_account(session)
                 account.name = newname
-                account_cache.set_modified(account.id)
-                reloaded = account_cache[account.id]
-                reloaded_again = account_cache[account.id]
+                account_cache.write_through(account.id) # so find_account_by_name can find it
+                posts.invalidate_encodings() # (The name appears in the encodings of this account's posts)
             else:
                 return { 'alert': 'Sorry, that name is already taken.' }
         elif act == 'change_pw':
@@ -186,7 +193,7 @@ def do_ajax(ob: Mapping[str, Any], session: sessions.Session) -> Dict[str, Any]:
                 acc = account_cache[acc_id]
                 acc.banned = True
                 account_cache.set_modified(acc_id)
-            rec.engine.banned_addresses.add(sess.addr)
+            rec.engine.ban(sess.addr)
         else:
             raise RuntimeError('unrecognized action')
         return {}
@@ -196,7 +203,7 @@ def do_ajax(ob: Mapping[str, Any], session: sessions.Session) -> Dict[str, Any]:
             'alert': str(e), # repr(e),
         }
 
-def do_account(query: Mapping[str, Any], session: sessions.Session) -> str:
+def do_account(query: Mapping[str, Any], session: sessions.Session) -> List[bytes]:
     account = active_account(session)
     if 'id' in query:
         account_to_show = account_cache[query['id']]
@@ -218,19 +225,21 @@ def do_account(query: Mapping[str, Any], session: sessions.Session) -> str:
         'let prev_query = ', str(session.query), ';\n',
         'let comments_pos = ', str(len(account.comments)), ';\n',
     ]
-    updated_account_page = account_page.replace('//<globals>//', ''.join(globals), 1)
-    return updated_account_page
+    return [ account_prefix, bytes(''.join(globals), 'utf8'), account_suffix ]
 
 def do_error_page(err: str, session: sessions.Session) -> str:
     return f'<html><body>{err}</body></html>'
 
-def receive_image(query: Mapping[str, Any], session: sessions.Session) -> str:
-    account = active_account(session)
+# Unlike the other page handlers, this one is called without holding cache.lock,
+# so that other requests may proceed while the image uploads
+def receive_image(query: Mapping[str, Any], session: sessions.Session) -> Union[str, List[bytes]]:
+    with cache.lock:
+        account = active_account(session)
 
     # Receive the file
     temp_filename = f'/tmp/{account.id}.jpeg'
     try:
-        webserver.sws.receive_file(temp_filename, 4000000)
+        webserver.current_request().receive_file(temp_filename, 4000000)
     except Exception as e:
         return do_error_page(str(e), session)
 
@@ -245,12 +254,16 @@ def receive_image(query: Mapping[str, Any], session: sessions.Session) -> str:
     img.save(final_filename)
 
     # Update the profile pic
-    account.image = final_filename
-    return do_account(query, session)
+    with cache.lock:
+        account = account_cache[account.id] # (It may have been evicted while the lock was released)
+        account.image = final_filename
+        account_cache.set_modified(account.id)
+        posts.invalidate_encodings()
+        return do_account(query, session)
 
 def active_account(session: sessions.Session) -> Account:
     account = account_cache[session.account_ids[session.active_index]]
     if account.banned:
-        rec.engine.banned_addresses.add(session.addr)
+        rec.engine.ban(session.addr)
         raise ValueError('Banned account')
     return account
@@ -0,0 +1,49 @@
+from typing import List, Any, Callable
+import os
+import random
+import string
+import tempfile
+import time
+import db
+import rec
+
+# Compares the flat file and SQLite backends on the operations the server uses most.
+# (Mongo is left out because it would write into the live 'debatestuff' database.)
+# Everything is written to a temporary folder, so no real data is touched.
+# Usage:
+#   python3 bench_db.py
+
+RATINGS = 100000
+USERS = 1000
+ITEMS = 10000
+
+def random_id() -> str:
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+
+def timed(name: str, count: int, func: Callable[[], Any]) -> None:
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'  {name}: {elapsed:.3f} s ({elapsed / count * 1000000.:.1f} us each)')
+
+def bench(name: str, backend: Any, user_ids: List[str], item_ids: List[str]) -> None:
+    print(name)
+    backend.load()
+    ratings = [ (random.choice(user_ids), random.choice(item_ids), [ float(random.randrange(2)) for _ in rec.rating_choices ]) for _ in range(RATINGS) ]
+    posts = [ (id, { 'par': '', 'type': 'rp', 'text': 'Some text', 'acc': random.choice(user_ids) }) for id in item_ids ]
+    timed('put_rating', RATINGS, lambda: [ backend.put_rating(user, item, vals) for user, item, vals in ratings ])
+    timed('put_posts (batches of 100)', len(posts), lambda: [ backend.put_posts(posts[i:i+100]) for i in range(0, len(posts), 100) ])
+    timed('get_post', len(posts), lambda: [ backend.get_post(id) for id, _ in posts ])
+    timed('get_posts (batches of 100)', len(posts), lambda: [ backend.get_posts(item_ids[i:i+100]) for i in range(0, len(item_ids), 100) ])
+    timed('get_ratings_for_rated_items (100 items)', 1000, lambda: [ backend.get_ratings_for_rated_items(random.choice(user_ids), random.sample(item_ids, 100)) for _ in range(1000) ])
+    timed('get_random_ratings (64 samples)', 1000, lambda: [ backend.get_random_ratings(64) for _ in range(1000) ])
+    timed('save', 1, lambda: backend.snapshot() if isinstance(backend, db.FlatFile) else backend.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)'))
+
+if __name__ == "__main__":
+    user_ids = [ random_id() for _ in range(USERS) ]
+    item_ids = [ random_id() for _ in range(ITEMS) ]
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        bench('FlatFile', db.FlatFile(), user_ids, item_ids)
+        bench('SQLite', db.SQLite('bench.sqlite'), user_ids, item_ids)
+        os.chdir('/')
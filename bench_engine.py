@@ -0,0 +1,179 @@
+from typing import Dict, List, Tuple, Mapping, Callable, Any, cast
+import json
+import os
+import random
+import resource
+import subprocess
+import tempfile
+import time
+import numpy as np
+import accounts
+import posts
+import rec
+from db import db
+from config import config
+
+# Measures the throughput, latency, memory, and prediction quality of rec.Engine on synthetic data.
+# Users and items get hidden factors, and each rating choice is drawn with a probability that depends on them,
+# so the ratings have latent structure the recommender could learn. Some ratings are held out to measure prediction error.
+# The results are written to bench_engine.json in the current folder. If that file already exists,
+# the new results are compared with it (flagging anything more than 10% worse), and it is renamed to bench_engine.prev.json.
+# Everything else happens in a temporary folder, so no real data is touched.
+# Usage:
+#   python3 bench_engine.py
+
+USERS = 2000
+ITEMS = 20000
+RATINGS = 200000
+HELD_OUT = 5000
+FACTORS = 4
+RATE_CALLS = 1000
+TRAIN_CALLS = 2000
+PREDICT_CALLS = 2000
+PREDICT_ITEMS = 20 # About as many as one feed poll needs
+GET_RATINGS_CALLS = 2000
+RECOMMEND_CALLS = 200
+RECOMMEND_CANDIDATES = 10 # About as many OPs as a category has
+TOLERANCE = 0.1 # Changes worse than this fraction are flagged as regressions
+
+# Times each call. Returns calls per second and latency percentiles in microseconds.
+def time_calls(func: Callable[[int], Any], n: int) -> Dict[str, float]:
+    latencies = np.zeros([n])
+    start = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter()
+        func(i)
+        latencies[i] = time.perf_counter() - t
+    elapsed = time.perf_counter() - start
+    p50, p90, p99 = np.percentile(latencies, [ 50, 90, 99 ]) * 1000000
+    return { 'ops_per_sec': n / elapsed, 'p50_us': float(p50), 'p90_us': float(p90), 'p99_us': float(p99) }
+
+# Makes the hidden structure, and returns a function that draws the ratings for a (user number, item number) pair
+def make_truth(rng: np.random.Generator) -> Callable[[int, int], List[float]]:
+    user_factors = rng.normal(0., 1., [USERS, FACTORS])
+    item_factors = rng.normal(0., 1., [ITEMS, FACTORS])
+    weights = rng.normal(0., 1., [FACTORS, len(rec.rating_choices)])
+    bias = rng.normal(-1.5, 1., [len(rec.rating_choices)])
+    def draw(u: int, i: int) -> List[float]:
+        p = 1. / (1. + np.exp(-(np.matmul(user_factors[u] * item_factors[i], weights) + bias)))
+        return cast(List[float], (rng.random(len(p)) < p).astype(np.float32).tolist())
+    return draw
+
+# Returns the root mean squared error of the engine's predictions for the held-out ratings,
+# and of always predicting the mean of each rating choice (which the engine should beat)
+def held_out_error(held_out: List[Tuple[str, str, List[float]]], means: np.ndarray) -> Tuple[float, float]:
+    by_user: Dict[str, List[Tuple[str, List[float]]]] = {}
+    for user, item, vals in held_out:
+        by_user.setdefault(user, []).append((item, vals))
+    model_errors: List[np.ndarray] = []
+    base_errors: List[np.ndarray] = []
+    for user, pairs in by_user.items():
+        predicted = rec.engine.get_ratings(user, [ item for item, _ in pairs ])
+        actual = np.array([ vals for _, vals in pairs ], dtype=np.float32)
+        known = ~np.isnan(predicted[:, 0])
+        model_errors.append((predicted[known] - actual[known]).ravel())
+        base_errors.append((means - actual[known]).ravel())
+    return float(np.sqrt(np.mean(np.square(np.concatenate(model_errors))))), float(np.sqrt(np.mean(np.square(np.concatenate(base_errors)))))
+
+def run() -> Mapping[str, Any]:
+    rng = np.random.default_rng(1234)
+    random.seed(1234)
+    np.random.seed(1234)
+    draw = make_truth(rng)
+    rec.engine.model = rec.make_model() # (made again after seeding, so runs are repeatable)
+
+    # Make users and items
+    user_ids = [ accounts.make_starter_account().id for _ in range(USERS) ]
+    item_ids = [ posts.new_post_id() for _ in range(ITEMS) ]
+    for id in item_ids:
+        posts.post_cache.add(id, posts.Post(id, '', '', 'op', 'Some text', random.choice(user_ids)))
+
+    # Seed the ratings (without training), holding some out
+    pairs = list({ (int(u), int(i)) for u, i in zip(rng.integers(0, USERS, RATINGS + HELD_OUT), rng.integers(0, ITEMS, RATINGS + HELD_OUT)) })
+    random.shuffle(pairs)
+    held_out = [ (user_ids[u], item_ids[i], draw(u, i)) for u, i in pairs[:HELD_OUT] ]
+    seeded = pairs[HELD_OUT:]
+    sums = np.zeros([len(rec.rating_choices)])
+    for u, i in seeded:
+        vals = draw(u, i)
+        sums += vals
+        db.put_rating(user_ids[u], item_ids[i], vals)
+        posts.post_cache[item_ids[i]].add_rating(vals) # (so rate can undo it if the pair is rated again)
+        posts.post_cache.set_modified(item_ids[i])
+    rec.Engine.ensure_profiles(rec.engine.user_profiles, user_ids)
+    rec.Engine.ensure_profiles(rec.engine.item_profiles, item_ids)
+    means = sums / len(seeded)
+
+    # Drive the engine
+    results: Dict[str, Any] = {}
+    new_pairs = [ (int(u), int(i)) for u, i in zip(rng.integers(0, USERS, RATE_CALLS), rng.integers(0, ITEMS, RATE_CALLS)) ]
+    new_ratings = [ draw(u, i) for u, i in new_pairs ]
+    results['rate'] = time_calls(lambda n: rec.engine.rate(user_ids[new_pairs[n][0]], item_ids[new_pairs[n][1]], new_ratings[n]), RATE_CALLS)
+    results['train'] = time_calls(lambda n: rec.engine.train(), TRAIN_CALLS)
+    user_profs = rec.engine.user_profiles.gather(np.arange(PREDICT_ITEMS))
+    item_profs = rec.engine.item_profiles.gather(np.arange(PREDICT_ITEMS))
+    results['predict'] = time_calls(lambda n: rec.engine.predict(user_profs, item_profs), PREDICT_CALLS)
+    results['predict']['predictions_per_sec'] = results['predict']['ops_per_sec'] * PREDICT_ITEMS
+    feed_user = rng.integers(0, USERS, GET_RATINGS_CALLS)
+    feed_items = rng.integers(0, ITEMS, [GET_RATINGS_CALLS, PREDICT_ITEMS])
+    results['get_ratings'] = time_calls(lambda n: rec.engine.get_ratings(user_ids[feed_user[n]], [ item_ids[i] for i in feed_items[n] ]), GET_RATINGS_CALLS)
+    recommend_user = rng.integers(0, USERS, RECOMMEND_CALLS)
+    recommend_start = rng.integers(0, ITEMS - RECOMMEND_CANDIDATES, RECOMMEND_CALLS)
+    results['recommend'] = time_calls(lambda n: rec.engine.recommend(user_ids[recommend_user[n]], str(n), item_ids[recommend_start[n]:recommend_start[n] + RECOMMEND_CANDIDATES], 6), RECOMMEND_CALLS)
+
+    # Check that a user who has never rated anything still gets a full list
+    new_user = accounts.make_starter_account().id
+    assert len(rec.engine.recommend(new_user, 'new_user', item_ids[:RECOMMEND_CANDIDATES], 6)) == 6, 'a user with no profile got a short list'
+
+    # Measure memory and quality
+    results['memory'] = {
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000.,
+        'ratings_mb': (db.ratings.vals.nbytes + db.ratings.users.nbytes + db.ratings.items.nbytes) / 1000000., # (The flat file's ratings table)
+        'profiles_mb': (rec.engine.user_profiles.matrix.nbytes + rec.engine.item_profiles.matrix.nbytes) / 1000000.,
+    }
+    model_rmse, baseline_rmse = held_out_error(held_out, means)
+    results['quality'] = { 'held_out_rmse': model_rmse, 'baseline_rmse': baseline_rmse }
+    return results
+
+# Returns the current git commit, or '' if there is none
+def git_commit() -> str:
+    try:
+        return subprocess.run([ 'git', 'rev-parse', '--short', 'HEAD' ], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+# Prints the change in each metric since the previous run, flagging the ones that got worse by more than TOLERANCE
+def compare(old: Mapping[str, Any], new: Mapping[str, Any]) -> None:
+    print(f'Compared with {old["commit"] or "the previous run"} ({old["time"]}):')
+    for group, metrics in new['results'].items():
+        for name, val in metrics.items():
+            if not name in old['results'].get(group, {}):
+                continue
+            prev = old['results'][group][name]
+            higher_is_better = name.endswith('_per_sec')
+            worse = (val < prev * (1. - TOLERANCE)) if higher_is_better else (val > prev * (1. + TOLERANCE))
+            flag = '  <-- REGRESSION' if worse and not name.startswith('max_rss') else ''
+            print(f'  {group}.{name}: {prev:.4g} -> {val:.4g} ({(val - prev) / prev * 100. if prev != 0 else 0.:+.1f}%){flag}')
+
+if __name__ == "__main__":
+    out_file = os.path.abspath('bench_engine.json')
+    commit = git_commit()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        db.load()
+        results = run()
+        os.chdir('/')
+    report = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': commit,
+        'rec_backend': config['rec_backend'],
+        'sizes': { 'users': USERS, 'items': ITEMS, 'ratings': RATINGS, 'held_out': HELD_OUT },
+        'results': results,
+    }
+    print(json.dumps(report, indent=2))
+    if os.path.exists(out_file):
+        with open(out_file) as infile:
+            compare(json.load(infile), report)
+        os.replace(out_file, os.path.splitext(out_file)[0] + '.prev.json')
+    with open(out_file, 'w') as outfile:
+        outfile.write(json.dumps(report, indent=2))
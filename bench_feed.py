@@ -0,0 +1,35 @@
+from typing import List, Union, Callable, Mapping, Any
+import io
+import time
+import sessions
+import accounts
+import feed
+import main
+import webserver
+
+# Measures how long it takes to generate the feed and account pages, compute their ETags, and write them to a socket.
+# Run from the directory that contains feed.html. Nothing is saved to the database.
+# Usage:
+#   python3 bench_feed.py
+
+def write_page(sink: io.BytesIO, content: Union[str, bytes, List[bytes]]) -> None:
+    chunks = webserver.to_chunks(content)
+    webserver.page_etag(chunks)
+    sink.writelines(chunks)
+
+def bench(name: str, handler: Callable[[Mapping[str, Any], sessions.Session], Any], reps: int) -> None:
+    session = sessions.get_or_make_session(sessions.new_session_id(), '')
+    sink = io.BytesIO()
+    for i in range(10): # warm up
+        write_page(sink, handler({}, session))
+    start = time.perf_counter()
+    for i in range(reps):
+        sink.seek(0)
+        write_page(sink, handler({}, session))
+    elapsed = time.perf_counter() - start
+    print(f'{name}: {elapsed / reps * 1000000.:.1f} us per page ({sink.tell()} bytes)')
+
+if __name__ == "__main__":
+    main.bootstrap()
+    bench('do_feed', feed.do_feed, 20000)
+    bench('do_account', accounts.do_account, 20000)
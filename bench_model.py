@@ -0,0 +1,72 @@
+from typing import Callable
+import subprocess
+import sys
+import time
+import numpy as np
+import rec
+
+# Compares the NumPy and TensorFlow backends of the recommender model:
+# startup time, predictions per second, training steps per second, and whether they compute the same thing.
+# Usage:
+#   python3 bench_model.py
+
+def startup_time(backend: str) -> float:
+    script = '\n'.join([
+        'import time',
+        'start = time.perf_counter()',
+        'import config',
+        f'config.config["rec_backend"] = "{backend}"',
+        'import rec',
+        'print(time.perf_counter() - start)',
+    ])
+    out = subprocess.run([ sys.executable, '-c', script ], capture_output=True, text=True, check=True).stdout
+    return float(out.strip().split('\n')[-1])
+
+def per_sec(func: Callable[[], None], reps: int) -> float:
+    func() # warm up
+    start = time.perf_counter()
+    for _ in range(reps):
+        func()
+    return reps / (time.perf_counter() - start)
+
+def bench(name: str, model: rec.Model, users: np.ndarray, items: np.ndarray, ratings: np.ndarray) -> None:
+    def predict() -> None:
+        model.set_users(users)
+        model.set_items(items)
+        model.predict()
+    def refine() -> None:
+        model.set_users(users)
+        model.set_items(items)
+        model.refine(ratings)
+    def predict_few() -> None:
+        model.predict_many(users[:20], items[:20]) # About as many as one feed poll needs
+    print(f'{name}: startup {startup_time(name):.2f} s, '
+        f'{per_sec(predict, 2000) * model.batch_size:.0f} predictions/sec, '
+        f'{per_sec(predict_few, 2000):.0f} calls/sec to predict 20, '
+        f'{per_sec(refine, 1000):.0f} training steps/sec')
+
+if __name__ == "__main__":
+    import tf_model
+    size = rec.PROFILE_SIZE
+    out = len(rec.rating_choices)
+    users = np.random.normal(0., 1., [64, size]).astype(np.float32)
+    items = np.random.normal(0., 1., [64, size]).astype(np.float32)
+    ratings = np.random.randint(0, 2, [64, out]).astype(np.float32)
+
+    # Check that both backends compute the same thing from the same params
+    np_model = rec.NumPyModel(size, out)
+    tf_mod = tf_model.Model(size, out)
+    tf_mod.unmarshal(np_model.marshal())
+    for model in [ np_model, tf_mod ]:
+        model.set_users(users)
+        model.set_items(items)
+    print(f'max prediction difference: {np.max(np.abs(np_model.predict() - tf_mod.predict())):.2e}')
+    for model in [ np_model, tf_mod ]:
+        for _ in range(100):
+            model.refine(ratings)
+    np_params = np_model.marshal()['params']
+    tf_params = tf_mod.marshal()['params']
+    print(f'max param difference after 100 training steps: {max([ np.max(np.abs(np.array(a) - np.array(b))) for a, b in zip(np_params, tf_params) ]):.2e}')
+
+    bench('numpy', np_model, users, items, ratings)
+    bench('tensorflow', tf_mod, users, items, ratings)
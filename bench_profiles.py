@@ -0,0 +1,72 @@
+from typing import Dict, List, Tuple, Mapping, Callable, Any
+import random
+import string
+import time
+import tracemalloc
+import numpy as np
+import cache
+import rec
+from profile_table import ProfileTable
+
+# Compares the old profile store (a cache.Cache holding one small array per id)
+# with ProfileTable, which keeps every profile in one float32 matrix.
+# Measures memory per profile and how fast a training batch of profiles can be gathered.
+# Usage:
+#   python3 bench_profiles.py
+
+PROFILES = 100000
+BATCH = 64
+
+def random_id() -> str:
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+
+# Returns the store and the number of bytes it allocated
+def measure(build: Callable[[], Any]) -> Tuple[Any, int]:
+    tracemalloc.start()
+    store = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return store, size
+
+def batches_per_sec(gather: Callable[[], Any]) -> float:
+    reps = 20000
+    start = time.perf_counter()
+    for _ in range(reps):
+        gather()
+    return reps / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    ids = [ random_id() for _ in range(PROFILES) ]
+    profiles = [ np.random.normal(0., 0.01, rec.PROFILE_SIZE) for _ in ids ]
+    db: Dict[str, np.ndarray] = {}
+    def get_many(keys: List[str]) -> Mapping[str, np.ndarray]:
+        return { key: db[key] for key in keys if key in db }
+    def put_many(items: List[Tuple[str, np.ndarray]]) -> None:
+        pass
+
+    # The cache is made big enough to hold every profile, so only the in-memory representation is compared
+    def build_old() -> cache.Cache[str, np.ndarray]:
+        c: cache.Cache[str, np.ndarray] = cache.Cache(PROFILES, lambda key: db[key], lambda key, val: None, 'old', get_many_func=get_many, put_many_func=put_many)
+        for id, vals in zip(ids, profiles):
+            c[id] = vals
+        return c
+
+    def build_new() -> ProfileTable:
+        table = ProfileTable(rec.PROFILE_SIZE, 'new', get_many, put_many)
+        for id, vals in zip(ids, profiles):
+            table.add(id, vals)
+        return table
+
+    batch = [ random.choice(ids) for _ in range(BATCH) ]
+    out = np.empty([BATCH, rec.PROFILE_SIZE], dtype=np.float32)
+    def old_gather() -> None:
+        found = old.get_many(batch)
+        for i in range(BATCH):
+            out[i] = found[batch[i]]
+    def new_gather() -> None:
+        out[:] = new.gather(new.find_many(batch))
+
+    old, old_size = measure(build_old)
+    print(f'Cache:        {old_size / PROFILES:.0f} bytes per profile, {batches_per_sec(old_gather):.0f} batches/sec')
+    new, new_size = measure(build_new)
+    print(f'ProfileTable: {new_size / PROFILES:.0f} bytes per profile, {batches_per_sec(new_gather):.0f} batches/sec')
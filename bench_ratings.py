@@ -0,0 +1,68 @@
+from typing import List, Tuple, Callable, Any
+import random
+import string
+import time
+import tracemalloc
+from indexable_dict import IndexableDict
+from ratings_table import RatingsTable
+
+# Compares the memory and sampling speed of the old ratings store (an IndexableDict keyed by 'user,item' strings)
+# with the columnar RatingsTable.
+# Usage:
+#   python3 bench_ratings.py
+
+RATINGS = 1000000
+USERS = 10000
+ITEMS = 100000
+WIDTH = 18
+BATCH = 64
+
+def random_id() -> str:
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+
+# How FlatFile.get_random_ratings used to work
+def old_sample(ratings: IndexableDict[str, List[float]], n: int) -> List[Tuple[str, str, List[float]]]:
+    results: List[Tuple[str, str, List[float]]] = []
+    for i in range(n):
+        key = ratings.random_key()
+        first_comma = key.index(',')
+        results.append((key[:first_comma], key[first_comma+1:], ratings[key]))
+    return results
+
+# Returns the store and the number of bytes it allocated
+def measure(build: Callable[[], Any]) -> Tuple[Any, int]:
+    tracemalloc.start()
+    store = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return store, size
+
+def samples_per_sec(sample: Callable[[], Any]) -> float:
+    reps = 2000
+    start = time.perf_counter()
+    for _ in range(reps):
+        sample()
+    return reps * BATCH / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    user_ids = [ random_id() for _ in range(USERS) ]
+    item_ids = [ random_id() for _ in range(ITEMS) ]
+    triples = [ (random.choice(user_ids), random.choice(item_ids), random.randrange(1 << WIDTH)) for _ in range(RATINGS) ]
+
+    def build_old() -> IndexableDict[str, List[float]]:
+        ratings: IndexableDict[str, List[float]] = IndexableDict()
+        for user, item, bits in triples:
+            ratings[f'{user},{item}'] = [ float((bits >> j) & 1) for j in range(WIDTH) ]
+        return ratings
+
+    def build_new() -> RatingsTable:
+        ratings = RatingsTable()
+        for user, item, bits in triples:
+            ratings.put(user, item, [ float((bits >> j) & 1) for j in range(WIDTH) ])
+        return ratings
+
+    old, old_size = measure(build_old)
+    print(f'IndexableDict: {old_size / len(old):.0f} bytes per rating, {samples_per_sec(lambda: old_sample(old, BATCH)):.0f} samples/sec')
+    del old
+    new, new_size = measure(build_new)
+    print(f'RatingsTable:  {new_size / len(new):.0f} bytes per rating, {samples_per_sec(lambda: new.sample(BATCH)):.0f} samples/sec, {samples_per_sec(lambda: new.sample_arrays(BATCH)):.0f} samples/sec as arrays')
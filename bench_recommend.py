@@ -0,0 +1,52 @@
+from typing import Dict, List, Tuple, Mapping, Callable
+import time
+import numpy as np
+import rec
+from item_index import ItemIndex
+from profile_table import ProfileTable
+
+# Measures how long a top-k recommendation query takes with the exact search and with the approximate (IVF) index,
+# and how many of the exact top k the approximate index finds.
+# Usage:
+#   python3 bench_recommend.py
+
+K = 6
+QUERIES = 200
+
+def no_profiles(ids: List[str]) -> Mapping[str, np.ndarray]:
+    return {}
+
+def no_store(items: List[Tuple[str, np.ndarray]]) -> None:
+    pass
+
+def usec_per_query(index: ItemIndex, queries: np.ndarray) -> Tuple[float, List[List[int]]]:
+    results: List[List[int]] = []
+    start = time.perf_counter()
+    for q in queries:
+        results.append(index.search(q, K))
+    return (time.perf_counter() - start) * 1000000 / len(queries), results
+
+if __name__ == "__main__":
+    model = rec.NumPyModel(rec.PROFILE_SIZE, len(rec.rating_choices))
+    weights, _ = model.get_common_layer()
+    for n in [ 1000, 100000, 1000000 ]:
+        profiles = ProfileTable(rec.PROFILE_SIZE, f'bench{n}', no_profiles, no_store)
+        ids = [ str(i) for i in range(n) ]
+        profiles.reserve(n)
+        for id, vals in zip(ids, np.random.normal(0., 0.01, [n, rec.PROFILE_SIZE]).astype(np.float32)):
+            profiles.append(id, vals)
+        queries = np.random.normal(0., 0.01, [QUERIES, rec.PROFILE_SIZE]).astype(np.float32) * np.matmul(weights, rec.rating_signs.astype(np.float32))
+
+        exact = ItemIndex(profiles, n, 0)
+        exact.update(ids)
+        exact_time, exact_results = usec_per_query(exact, queries)
+        line = f'{n} items: exact {exact_time:.0f} us/query'
+        if n > 20000:
+            start = time.perf_counter()
+            ivf = ItemIndex(profiles, 20000, 8)
+            ivf.update(ids)
+            build_time = time.perf_counter() - start
+            ivf_time, ivf_results = usec_per_query(ivf, queries)
+            recall = np.mean([ len(set(a) & set(b)) / K for a, b in zip(exact_results, ivf_results) ])
+            line += f', IVF {ivf_time:.0f} us/query (built in {build_time:.1f} s, recall@{K} {recall:.2f})'
+        print(line)
@@ -0,0 +1,89 @@
+from typing import Dict, Mapping, Any, List
+import json
+import os
+import random
+import string
+import tempfile
+import time
+import db
+import rec
+from ratings_table import RatingsTable
+
+# Measures how long the flat file database takes to start up with a synthetic database of a million ratings.
+# Compares the old single state.json file with the per-collection files, which are loaded lazily.
+# Everything is written to a temporary folder, so no real data is touched.
+# Usage:
+#   python3 bench_startup.py
+
+RATINGS = 1000000
+USERS = 10000
+ITEMS = 100000
+
+def random_id() -> str:
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+
+def make_collections() -> Dict[str, Any]:
+    user_ids = [ random_id() for _ in range(USERS) ]
+    item_ids = [ random_id() for _ in range(ITEMS) ]
+    ratings = RatingsTable()
+    while len(ratings) < RATINGS:
+        vals = [ float(random.randrange(2)) for _ in rec.rating_choices ]
+        ratings.put(random.choice(user_ids), random.choice(item_ids), vals)
+    return {
+        'sessions': {},
+        'accounts': { id: { 'name': id, 'image': '', 'rating_count': 100 } for id in user_ids },
+        'notif_in': {},
+        'notif_out': {},
+        'posts': { id: { 'par': '', 'type': 'rp', 'text': 'Some text', 'acc': random.choice(user_ids) } for id in item_ids },
+        'history': {},
+        'user_profiles': {},
+        'item_profiles': {},
+        'ratings': ratings,
+        'engine': {},
+    }
+
+def timed(name: str, start: float) -> float:
+    now = time.perf_counter()
+    print(f'{name}: {now - start:.3f} s')
+    return now
+
+if __name__ == "__main__":
+    print(f'Generating {RATINGS} ratings...')
+    collections = make_collections()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+
+        # The old format: everything in one state.json file
+        start = time.perf_counter()
+        packet: Mapping[str, Any] = { name: (val.to_mapping() if name == 'ratings' else val) for name, val in collections.items() }
+        with open(db.legacy_file, mode='wb') as file:
+            file.write(bytes(json.dumps(packet), 'utf8'))
+        timed(f'write {db.legacy_file} ({os.path.getsize(db.legacy_file) // 1000000} MB)', start)
+        start = time.perf_counter()
+        with open(db.legacy_file, mode='rb') as infile:
+            packet = json.loads(infile.read())
+        RatingsTable.from_mapping(packet['ratings'])
+        timed(f'load {db.legacy_file}', start)
+        os.remove(db.legacy_file)
+        del packet
+
+        # The new format: one file per collection
+        flat = db.FlatFile()
+        for name in db.collection_names:
+            flat.__dict__[name] = collections[name]
+            flat.dirty.add(name)
+        start = time.perf_counter()
+        flat.snapshot()
+        size = sum([ os.path.getsize(os.path.join(db.state_dir, f)) for f in os.listdir(db.state_dir) ])
+        timed(f'write {db.state_dir} folder ({size // 1000000} MB)', start)
+        del flat
+        del collections
+
+        flat = db.FlatFile()
+        start = time.perf_counter()
+        flat.load()
+        flat.have_no_accounts()
+        start = timed(f'load {db.state_dir} folder until ready to serve', start)
+        flat.get_ratings_for_rated_items(random_id(), [ random_id() ])
+        timed(f'first use of ratings ({len(flat.ratings)} ratings)', start)
+        os.chdir('/')
@@ -0,0 +1,110 @@
+from typing import List, Tuple, Iterator, Optional
+import argparse
+import queue
+import threading
+import time
+import numpy as np
+import rec
+from db import db
+
+# Retrains the recommender offline, with passes (epochs) over every rating in the database
+# instead of the random batches that the online trainer samples one round trip at a time.
+# The database must not be in use by a running server.
+# Usage:
+#   python3 main.py <folder> train [--epochs N] [--batch-size N] [--learning-rate X] [--chunk-size N] [--window N] [--resume]
+
+Chunk = Tuple[List[str], List[str], np.ndarray] # (user ids, item ids, ratings matrix)
+
+# Streams all the ratings from the database on its own thread,
+# so reading and decoding the next chunk overlaps with training on the current one
+class RatingsLoader(threading.Thread):
+    def __init__(self, chunk_size: int) -> None:
+        threading.Thread.__init__(self, daemon=True)
+        self.chunk_size = chunk_size
+        self.queue: queue.Queue[Optional[Chunk]] = queue.Queue(4)
+        self.error: Optional[BaseException] = None
+
+    def run(self) -> None:
+        try:
+            for chunk in db.iter_ratings(self.chunk_size):
+                self.queue.put(chunk)
+        except BaseException as e:
+            self.error = e
+        self.queue.put(None)
+
+    # Yields the chunks as they arrive. Raises any error the loader hit.
+    def chunks(self) -> Iterator[Chunk]:
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            yield chunk
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+# Groups the chunks into windows of at least window_size ratings, as (user profile rows, item profile rows, ratings matrix).
+# Users and items without profiles are given new ones, like online training does.
+def windows(chunks: Iterator[Chunk], window_size: int) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    parts: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+    size = 0
+    for user_ids, item_ids, vals in chunks:
+        user_rows = rec.Engine.ensure_profiles(rec.engine.user_profiles, user_ids)
+        item_rows = rec.Engine.ensure_profiles(rec.engine.item_profiles, item_ids)
+        parts.append((user_rows, item_rows, vals))
+        size += len(vals)
+        if size >= window_size:
+            yield np.concatenate([ p[0] for p in parts ]), np.concatenate([ p[1] for p in parts ]), np.concatenate([ p[2] for p in parts ])
+            parts = []
+            size = 0
+    if len(parts) > 0:
+        yield np.concatenate([ p[0] for p in parts ]), np.concatenate([ p[1] for p in parts ]), np.concatenate([ p[2] for p in parts ])
+
+# Trains one pass over all the ratings, shuffled within each window.
+# (Ratings left over at the end of a window are carried into the next one. Fewer than a batch are left out at the end.)
+# Returns the mean loss (before each step) and the number of ratings trained on.
+def train_epoch(model: rec.Model, chunk_size: int, window_size: int) -> Tuple[float, int]:
+    loader = RatingsLoader(chunk_size)
+    loader.start()
+    bs = model.batch_size
+    total_loss = 0.
+    batches = 0
+    carried: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+    for user_rows, item_rows, vals in windows(loader.chunks(), window_size):
+        if carried is not None:
+            user_rows = np.concatenate([ carried[0], user_rows ])
+            item_rows = np.concatenate([ carried[1], item_rows ])
+            vals = np.concatenate([ carried[2], vals ])
+        order = np.random.permutation(len(vals))
+        n_batches = len(vals) // bs
+        for i in range(n_batches):
+            batch = order[i * bs:(i + 1) * bs]
+            model.set_users(rec.engine.user_profiles.gather(user_rows[batch]))
+            model.set_items(rec.engine.item_profiles.gather(item_rows[batch]))
+            y = vals[batch]
+            total_loss += float(np.mean(np.sum(np.square(model.predict() - y), axis=1)))
+            model.refine(y)
+        batches += n_batches
+        rest = order[n_batches * bs:]
+        carried = (user_rows[rest], item_rows[rest], vals[rest])
+    return (total_loss / batches if batches > 0 else 0.), batches * bs
+
+def run(args: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog='main.py <folder> train', description='Retrains the recommender model with full passes over all the ratings')
+    parser.add_argument('--epochs', type=int, default=10, help='passes over all the ratings')
+    parser.add_argument('--batch-size', type=int, default=1024, help='ratings per training step')
+    parser.add_argument('--learning-rate', type=float, default=rec.LEARNING_RATE)
+    parser.add_argument('--chunk-size', type=int, default=10000, help='ratings to read from the database at a time')
+    parser.add_argument('--window', type=int, default=200000, help='ratings to shuffle together')
+    parser.add_argument('--resume', action='store_true', help='start from the current model instead of from scratch')
+    opts = parser.parse_args(args)
+
+    model = rec.make_model(opts.batch_size, opts.learning_rate)
+    if opts.resume:
+        model.unmarshal(rec.engine.model.marshal())
+    for epoch in range(opts.epochs):
+        start = time.perf_counter()
+        loss, n = train_epoch(model, opts.chunk_size, opts.window)
+        elapsed = time.perf_counter() - start
+        print(f'Epoch {epoch + 1}/{opts.epochs}: loss={loss:.5f}, {n} ratings in {elapsed:.1f} s ({n / elapsed:.0f} ratings/sec)')
+    rec.engine.model.unmarshal(model.marshal())
@@ -1,20 +1,226 @@
-from typing import TypeVar, Generic, Callable, Set
+from typing import TypeVar, Generic, Callable, Dict, List, Mapping, Any, Optional, Tuple, Iterable, cast
+from collections import OrderedDict
 from indexable_dict import IndexableDict
+from config import config
+import threading
+import time
 
 K = TypeVar('K')
 V = TypeVar('V')
 
+# Guards all of the module-level caches (and the objects they hold).
+# Any thread that reads or modifies cached objects must hold this lock.
+lock = threading.RLock()
+
+# Notified whenever something that clients wait for (an OP history or a notification count) changes
+changed = threading.Condition(lock)
+
+# Wakes up all the requests that are waiting for changes
+def notify_changed() -> None:
+    with lock:
+        changed.notify_all()
+
+# Decides which item a cache should release when it gets too full.
+# The cache tells the policy about every key it inserts, accesses, and removes.
+class EvictionPolicy(Generic[K]):
+    def on_insert(self, key: K) -> None:
+        raise NotImplementedError('Expected an override')
+
+    def on_access(self, key: K) -> None:
+        raise NotImplementedError('Expected an override')
+
+    def on_remove(self, key: K) -> None:
+        raise NotImplementedError('Expected an override')
+
+    # Returns the key that should be released next
+    def victim(self) -> K:
+        raise NotImplementedError('Expected an override')
+
+# Releases a random item
+class RandomPolicy(EvictionPolicy[K]):
+    def __init__(self) -> None:
+        self.keys: IndexableDict[K, bool] = IndexableDict()
+
+    def on_insert(self, key: K) -> None:
+        self.keys[key] = True
+
+    def on_access(self, key: K) -> None:
+        pass
+
+    def on_remove(self, key: K) -> None:
+        self.keys.drop(key)
+
+    def victim(self) -> K:
+        return self.keys.random_key()
+
+# Releases the least-recently used item
+class LRUPolicy(EvictionPolicy[K]):
+    def __init__(self) -> None:
+        self.keys: OrderedDict[K, bool] = OrderedDict()
+
+    def on_insert(self, key: K) -> None:
+        self.keys[key] = True
+
+    def on_access(self, key: K) -> None:
+        self.keys.move_to_end(key)
+
+    def on_remove(self, key: K) -> None:
+        del self.keys[key]
+
+    def victim(self) -> K:
+        return next(iter(self.keys))
+
+# Approximates LRU with one reference bit per item.
+# Cheaper than LRU on access, since nothing is reordered.
+class ClockPolicy(EvictionPolicy[K]):
+    def __init__(self) -> None:
+        self.keys: IndexableDict[K, bool] = IndexableDict() # Maps each key to its reference bit
+        self.hand = 0
+
+    def on_insert(self, key: K) -> None:
+        self.keys[key] = False
+
+    def on_access(self, key: K) -> None:
+        self.keys[key] = True
+
+    def on_remove(self, key: K) -> None:
+        self.keys.drop(key)
+
+    def victim(self) -> K:
+        assert len(self.keys) > 0, 'No keys to choose from'
+        keys = self.keys.keys()
+        refs = self.keys.vals()
+        while True:
+            if self.hand >= len(keys):
+                self.hand = 0
+            if refs[self.hand]:
+                refs[self.hand] = False
+                self.hand += 1
+            else:
+                return keys[self.hand]
+
+# Estimates how often each key has been accessed recently, in constant space
+class FrequencySketch(Generic[K]):
+    def __init__(self, max_size: int) -> None:
+        self.width = 16
+        while self.width < 4 * max_size:
+            self.width *= 2
+        self.rows: List[List[int]] = [ [ 0 ] * self.width for _ in range(4) ]
+        self.additions = 0
+        self.sample_size = 10 * max_size
+
+    def increment(self, key: K) -> None:
+        for i, row in enumerate(self.rows):
+            j = hash((i, key)) & (self.width - 1)
+            if row[j] < 15:
+                row[j] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            # Age all the counts, so that items that were popular long ago do not stay forever
+            for row in self.rows:
+                for j in range(len(row)):
+                    row[j] >>= 1
+            self.additions //= 2
+
+    def frequency(self, key: K) -> int:
+        return min([ row[hash((i, key)) & (self.width - 1)] for i, row in enumerate(self.rows) ])
+
+# Window TinyLFU. New items enter a small LRU window.
+# When the window overflows, its oldest item competes with the oldest item in the main LRU region,
+# and whichever has been accessed less often (according to a frequency sketch) is released.
+# This keeps popular items resident when a burst of one-time accesses sweeps through the cache.
+class TinyLFUPolicy(EvictionPolicy[K]):
+    def __init__(self, max_size: int) -> None:
+        self.window_size = max(1, max_size // 100)
+        self.window: OrderedDict[K, bool] = OrderedDict()
+        self.main: OrderedDict[K, bool] = OrderedDict()
+        self.sketch: FrequencySketch[K] = FrequencySketch(max_size)
+
+    def on_insert(self, key: K) -> None:
+        self.sketch.increment(key)
+        self.window[key] = True
+        if len(self.window) > self.window_size:
+            # There is room in the cache, so the oldest item in the window moves to the main region without a contest
+            oldest = next(iter(self.window))
+            del self.window[oldest]
+            self.main[oldest] = True
+
+    def on_access(self, key: K) -> None:
+        self.sketch.increment(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+        else:
+            self.main.move_to_end(key)
+
+    def on_remove(self, key: K) -> None:
+        if key in self.window:
+            del self.window[key]
+        else:
+            del self.main[key]
+
+    def victim(self) -> K:
+        if len(self.main) == 0:
+            return next(iter(self.window))
+        if len(self.window) < self.window_size:
+            return next(iter(self.main))
+        candidate = next(iter(self.window))
+        main_victim = next(iter(self.main))
+        if self.sketch.frequency(candidate) > self.sketch.frequency(main_victim):
+            # Admit the candidate to the main region
+            del self.window[candidate]
+            self.main[candidate] = True
+            return main_victim
+        else:
+            return candidate
+
+def make_policy(name: str, max_size: int) -> EvictionPolicy[K]:
+    if name == 'random':
+        return RandomPolicy()
+    elif name == 'lru':
+        return LRUPolicy()
+    elif name == 'clock':
+        return ClockPolicy()
+    elif name == 'tinylfu':
+        return TinyLFUPolicy(max_size)
+    else:
+        raise ValueError(f'Unrecognized cache policy: {name}')
+
+# Everything the write-behind flusher writes back and print_stats reports on.
+# (Mostly Cache objects, but anything with write_back, flush, and stats methods can register here.)
+all_caches: List[Any] = []
+
 # A cache for wrapping a database collection.
 # Holds up to max_size objects in memory.
-# Releases random objects when the cache gets too full.
+# Releases objects chosen by its eviction policy when the cache gets too full.
+# (If no policy name is specified, config['cache_policy'] is used.)
 # Only writes objects back to the database for which set_modified has been called.
+# If get_many_func and put_many_func are supplied, they are used to fetch or store many objects in one database round trip.
+# get_many_func should omit keys that are not in the database.
 class Cache(Generic[K,V]):
-    def __init__(self, max_size: int, get_func: Callable[[K],V], put_func: Callable[[K,V],None]) -> None:
+    def __init__(self,
+        max_size: int,
+        get_func: Callable[[K],V],
+        put_func: Callable[[K,V],None],
+        name: str,
+        policy: str = '',
+        get_many_func: Optional[Callable[[List[K]],Mapping[K,V]]] = None,
+        put_many_func: Optional[Callable[[List[Tuple[K,V]]],None]] = None,
+    ) -> None:
         self.max_size = max_size
         self.get_func = get_func
         self.put_func = put_func
+        self.get_many_func = get_many_func
+        self.put_many_func = put_many_func
+        self.name = name
+        self.policy: EvictionPolicy[K] = make_policy(policy if len(policy) > 0 else str(config['cache_policy']), max_size)
         self.cache: IndexableDict[K,V] = IndexableDict()
-        self.modified: Set[K] = set()
+        self.modified: Dict[K, float] = {} # Maps each modified key to the time it was first modified
+        self.max_modified = cast(int, config['write_behind_max_dirty'])
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.write_backs = 0
+        all_caches.append(self)
 
     # This returns true iff the cache contains the key.
     # If you want to know whether the database collection contains the key,
@@ -26,9 +232,13 @@ class Cache(Generic[K,V]):
     def __len__(self) -> int:
         return len(self.cache)
 
-    # Flags an item to be written to the database when it is released
+    # Flags an item to be written to the database when it is released (or sooner by the write-behind flusher)
     def set_modified(self, key: K) -> None:
-        self.modified.add(key)
+        if not key in self.modified:
+            self.modified[key] = time.monotonic()
+            if len(self.modified) > self.max_modified:
+                # Apply backpressure: The flusher is not keeping up, so the caller pays for a batch of writes
+                self.write_back(len(self.modified) - self.max_modified // 2, time.monotonic())
 
     # Returns true iff this item has been flagged as modified
     def has_been_modified(self, key: K) -> bool:
@@ -39,29 +249,171 @@ class Cache(Generic[K,V]):
     def release(self, key: K) -> None:
         if self.has_been_modified(key):
             self.put_func(key, self.cache[key])
+            del self.modified[key]
         self.cache.drop(key)
+        self.policy.on_remove(key)
+
+    # Writes up to max_count modified items (that were first modified before the specified time) to the database.
+    # The items remain in the cache, but are no longer flagged as modified.
+    # Returns the number of items that were written.
+    def write_back(self, max_count: int, modified_before: float) -> int:
+        written: List[K] = []
+        for key, t in self.modified.items(): # (in the order they were modified)
+            if len(written) >= max_count or t >= modified_before:
+                break
+            written.append(key)
+        self.store_many([ (key, self.cache[key]) for key in written if key in self.cache ])
+        for key in written:
+            del self.modified[key]
+        self.write_backs += len(written)
+        return len(written)
+
+    # Writes the specified item to the database right away, instead of waiting for the flusher
+    def write_through(self, key: K) -> None:
+        self.put_func(key, self.cache[key])
+        if key in self.modified:
+            del self.modified[key]
+        self.write_backs += 1
+
+    # Writes a batch of items to the database
+    def store_many(self, items: List[Tuple[K,V]]) -> None:
+        if len(items) == 0:
+            return
+        if self.put_many_func is not None:
+            self.put_many_func(items)
+        else:
+            for key, val in items:
+                self.put_func(key, val)
 
     # Releases items until this cache is empty
     def flush(self) -> None:
+        self.write_back(len(self.modified), float('inf'))
         while len(self.cache) > 0:
             self.release(self.cache.random_key())
 
     # Retrieves the specified item. Hits the database only if necessary.
     def __getitem__(self, key: K) -> V:
         if key in self.cache:
+            self.hits += 1
+            self.policy.on_access(key)
             return self.cache[key]
+        self.misses += 1
         val = self.get_func(key)
         self[key] = val
         return val
 
-    # Stores the specified item in this cache. Releases a random item if necessary to keep the cache size limited.
+    # Stores the specified item in this cache. Releases an item if necessary to keep the cache size limited.
     def __setitem__(self, key: K, val: V) -> None:
-        if len(self.cache) >= self.max_size:
-            self.release(self.cache.random_key())
+        if key in self.cache:
+            self.policy.on_access(key)
+        else:
+            if len(self.cache) >= self.max_size:
+                self.release(self.policy.victim())
+                self.evictions += 1
+            self.policy.on_insert(key)
         self.cache[key] = val
 
+    # Retrieves many items at once. Fetches all the items that are not in this cache with a single database call.
+    # Returns a mapping from keys to items. Keys that are not in the database are omitted.
+    def get_many(self, keys: Iterable[K]) -> Dict[K, V]:
+        results: Dict[K, V] = {}
+        missing: Dict[K, bool] = {} # (Used as an ordered set)
+        for key in keys:
+            if key in self.cache:
+                self.hits += 1
+                self.policy.on_access(key)
+                results[key] = self.cache[key]
+            else:
+                missing[key] = True
+        if len(missing) == 0:
+            return results
+        self.misses += len(missing)
+        if self.get_many_func is not None:
+            fetched = self.get_many_func(list(missing))
+        else:
+            fetched = {}
+            for key in missing:
+                try:
+                    fetched[key] = self.get_func(key)
+                except KeyError:
+                    pass
+        for key in missing:
+            if key in fetched:
+                val = fetched[key]
+                self[key] = val
+                results[key] = val
+        return results
+
     # A convenience method that: (1) adds a key-val pair to the cache, (2) flags it as modified, and (3) returns val
     def add(self, key: K, val: V) -> V:
         self[key] = val
         self.set_modified(key)
         return val
+
+    # Adds many key-val pairs to the cache and flags them all as modified
+    def put_many(self, items: Iterable[Tuple[K, V]]) -> None:
+        for key, val in items:
+            self.add(key, val)
+
+    # Returns counters that describe how well this cache is working
+    def stats(self) -> Mapping[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'name': self.name,
+            'policy': type(self.policy).__name__,
+            'size': len(self.cache),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'write_backs': self.write_backs,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.,
+        }
+
+def print_stats() -> None:
+    for c in all_caches:
+        st = c.stats()
+        print(f'{st["name"]} cache ({st["policy"]}, {st["size"]}/{st["max_size"]}): {st["hits"]} hits, {st["misses"]} misses, {st["evictions"]} evictions, {st["write_backs"]} write-backs, hit rate={st["hit_rate"]:.3f}')
+
+# Periodically writes modified items in all the caches back to the database,
+# so that a crash loses only recent changes and shutdown does not stall on one huge flush.
+# Items that have been modified for longer than the interval are written in batches,
+# and the lock is released between batches so requests are not blocked for long.
+class WriteBehindFlusher(threading.Thread):
+    def __init__(self, interval: float, batch_size: int) -> None:
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopping = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopping.wait(self.interval):
+            self.flush_stale()
+
+    def flush_stale(self) -> None:
+        cutoff = time.monotonic() - self.interval
+        for c in all_caches:
+            while not self.stopping.is_set():
+                with lock:
+                    n = c.write_back(self.batch_size, cutoff)
+                if n < self.batch_size:
+                    break
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.join()
+
+flusher: Optional[WriteBehindFlusher] = None
+
+def start_flusher() -> None:
+    global flusher
+    interval = cast(float, config['write_behind_interval'])
+    if interval > 0.:
+        flusher = WriteBehindFlusher(interval, cast(int, config['write_behind_batch']))
+        flusher.start()
+
+def stop_flusher() -> None:
+    global flusher
+    if flusher is not None:
+        flusher.stop()
+        flusher = None
@@ -6,6 +6,26 @@ config = {
     'use_mongo': False, # Override with True to store data in a Mongo database instead of a flat file
     'mongo_url': 'mongodb://localhost', # Only used if use_mongo is True
     'mongo_port': 27017, # Only used if use_mongo is True
+    'use_sqlite': False, # Override with True to store data in a SQLite database file instead of a flat file
+    'sqlite_file': 'debatestuff.sqlite', # Only used if use_sqlite is True
+    'port': 8986, # The port the web server listens on
+    'server_mode': 'threaded', # 'single' serves one request at a time. 'threaded' serves each connection on its own thread.
+    'cache_policy': 'lru', # How caches choose items to release when full: 'random', 'lru', 'clock', or 'tinylfu'
+    'write_behind_interval': 5., # Seconds between writing modified cache items back to the database (0 to only write them when released)
+    'write_behind_batch': 100, # Max items to write back while holding the lock
+    'write_behind_max_dirty': 2000, # When a cache has more modified items than this, writers flush some themselves
+    'long_poll_timeout': 25., # Max seconds to park a client waiting for feed updates (only used if server_mode is 'threaded')
+    'history_max_deltas': 1000, # Compact an OP's history when it holds more than this many post updates and removals (after which clients that were behind download the whole thread again)
+    'journal_compact_size': 64000000, # Compact the flat file journal into a new snapshot when it grows past this many bytes (0 to only compact at startup and shutdown)
+    'rec_backend': 'numpy', # Which library runs the recommender model: 'numpy' or 'tensorflow' (both save the same params)
+    'train_in_background': True, # Train the recommender on a background thread instead of while handling each rating
+    'train_steps_per_rating': 5, # Batches of training to do for each new rating
+    'train_interval': 0., # If positive, seconds of idleness after which the background trainer does another batch
+    'train_max_queue': 1000, # Max new ratings waiting for the background trainer. (More are dropped from training, but still saved.)
+    'rec_publish_interval': 10., # Max seconds before the feed sees a newly trained model. (Cached aion scores are kept until then.)
+    'profile_dir': '', # If set, user and item profiles are kept in memory-mapped files in this folder instead of in the database
+    'rec_exact_max': 20000, # Recommendations score every candidate if there are at most this many, or use an approximate (IVF) index if there are more
+    'rec_ivf_probes': 8, # Inverted lists to search per recommendation when using the approximate index
     'bootstrap': # Values to pre-populate an empty database. (Only a root category is really needed. The rest is just fluff.)
     { 'type': 'cat', 'text': 'Everything', 'children': [
         { 'type': 'cat', 'text': 'Politics', 'children': [
@@ -57,8 +77,8 @@ if len(sys.argv) > 1:
 print('__________________________________________________')
 print(f'Starting up in dir: {os.getcwd()}')
 print('(Note: The starting directory can be specified with the first argument to the application.')
-print('That is the only command-line argument. All other settings are specified in config.json,')
-print('which should be found in that directory, along with other required files.)')
+print('All other settings are specified in config.json, which should be found in that directory,')
+print('along with other required files. A second argument of "train" retrains the recommender and exits.)')
 if os.path.exists('config.json'):
     with open('config.json', mode='rb') as file:
         filecontents = file.read()
@@ -1,8 +1,12 @@
-from typing import Optional, Dict, Mapping, Any, List, Tuple, cast
+from typing import Optional, Dict, Mapping, Any, List, Tuple, Set, BinaryIO, Iterator, cast
 import pymongo
 import json
 import os
-from indexable_dict import IndexableDict
+import random
+import sqlite3
+import threading
+import numpy as np
+from ratings_table import RatingsTable, split_key
 from config import config
 
 def flush_caches() -> None:
@@ -18,85 +22,215 @@ def flush_caches() -> None:
     rec.engine.user_profiles.flush()
     rec.engine.item_profiles.flush()
 
-# An in-memory "database" that periodically writes to a flat file
+state_dir = 'state' # Holds one snapshot file per collection, plus the journal
+journal_file = os.path.join(state_dir, 'journal')
+legacy_file = 'state.json' # The old format, with everything in one file
+collection_names = [ 'sessions', 'accounts', 'notif_in', 'notif_out', 'posts', 'history', 'user_profiles', 'item_profiles', 'ratings', 'engine' ]
+
+# Writes a file so that a crash at any point leaves either the old version or the new one intact
+def write_atomically(filename: str, blobs: List[bytes]) -> None:
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, mode='wb') as file:
+        file.writelines(blobs)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_file, filename)
+
+# An in-memory "database" that appends every put to a journal file,
+# and periodically compacts the journal into per-collection snapshot files.
+# Each collection is loaded from its snapshot file the first time it is used.
 class FlatFile():
+    sessions: Dict[str, Mapping[str, Any]]
+    accounts: Dict[str, Mapping[str, Any]]
+    notif_in: Dict[str, Mapping[str, Any]]
+    notif_out: Dict[str, Mapping[str, Any]]
+    posts: Dict[str, Mapping[str, Any]]
+    history: Dict[str, Mapping[str, Any]]
+    user_profiles: Dict[str, Mapping[str, Any]]
+    item_profiles: Dict[str, Mapping[str, Any]]
+    ratings: RatingsTable
+    engine: Mapping[str, Any]
+
     def __init__(self) -> None:
-        self.sessions: Dict[str, Mapping[str, Any]] = {}
-        self.accounts: Dict[str, Mapping[str, Any]] = {}
-        self.notif_in: Dict[str, Mapping[str, Any]] = {}
-        self.notif_out: Dict[str, Mapping[str, Any]] = {}
-        self.posts: Dict[str, Mapping[str, Any]] = {}
-        self.history: Dict[str, Mapping[str, Any]] = {}
-        self.user_profiles: Dict[str, Mapping[str, Any]] = {}
-        self.item_profiles: Dict[str, Mapping[str, Any]] = {}
-        self.ratings: IndexableDict[str, List[float]] = IndexableDict()
-        self.engine: Mapping[str, Any] = {}
-
-    # Save all the data to a flat file
+        self.pending: Dict[str, List[Tuple[str, Any]]] = {} # Journal entries for collections that have not been loaded yet
+        self.dirty: Set[str] = set() # Collections that have changed since the last snapshot
+        self.load_lock = threading.Lock()
+        self.account_names: Optional[Dict[str, str]] = None # Maps names to account ids. Built when first needed.
+        self.journal: Optional[BinaryIO] = None # Not opened until load is called
+        self.journal_size = 0
+        self.compact_size = cast(int, config['journal_compact_size'])
+
+    # Python calls this when an attribute is not found, which is how collections get loaded lazily
+    def __getattr__(self, name: str) -> Any:
+        if name not in collection_names:
+            raise AttributeError(name)
+        with self.load_lock:
+            if name not in self.__dict__:
+                self.__dict__[name] = self.read_collection(name)
+        return self.__dict__[name]
+
+    # Reads a collection from its snapshot file and applies any journal entries for it
+    def read_collection(self, name: str) -> Any:
+        filename = os.path.join(state_dir, f'{name}.bin' if name == 'ratings' else f'{name}.json')
+        collection: Any
+        if name == 'ratings':
+            collection = RatingsTable()
+            if os.path.exists(filename):
+                with open(filename, mode='rb') as file:
+                    collection = RatingsTable.from_file(file)
+        elif os.path.exists(filename):
+            with open(filename, mode='rb') as file:
+                collection = json.loads(file.read())
+        else:
+            collection = {}
+        for id, doc in self.pending.pop(name, []):
+            if name == 'engine':
+                collection = doc
+            elif name == 'ratings':
+                user, item = split_key(id)
+                collection.put(user, item, doc)
+            else:
+                collection[id] = doc
+        return collection
+
+    # Writes a collection to its snapshot file
+    def write_collection(self, name: str) -> None:
+        if name == 'ratings':
+            write_atomically(os.path.join(state_dir, 'ratings.bin'), self.ratings.to_blobs())
+        else:
+            write_atomically(os.path.join(state_dir, f'{name}.json'), [ bytes(json.dumps(getattr(self, name)), 'utf8') ])
+
+    # Appends some put operations to the journal with a single write.
+    # Compacts the journal into new snapshots if it has grown too big.
+    def log(self, collection: str, docs: List[Tuple[str, Any]]) -> None:
+        if self.journal is None or len(docs) == 0:
+            return
+        blob = b''.join([ bytes(json.dumps([collection, id, doc]), 'utf8') + b'\n' for id, doc in docs ])
+        self.journal.write(blob)
+        self.journal_size += len(blob)
+        self.dirty.add(collection)
+        if self.compact_size > 0 and self.journal_size > self.compact_size:
+            self.snapshot()
+
+    # Rewrites the snapshot file of each collection that has changed, then starts a new empty journal.
+    # (If we crash part way through, the old journal is still there to bring the older files up to date.)
+    def snapshot(self) -> None:
+        os.makedirs(state_dir, exist_ok=True)
+        for name in collection_names:
+            if name in self.dirty or name in self.pending:
+                self.write_collection(name)
+        self.dirty.clear()
+
+        # Everything in the journal is now in the snapshots.
+        # (If we crash before truncating it, replaying it again is harmless because puts are idempotent.)
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(journal_file, mode='wb', buffering=0)
+        self.journal_size = 0
+
+    # Holds the entries in the journal until their collections are loaded, then opens it for appending.
+    # Returns the number of entries.
+    def replay(self) -> int:
+        count = 0
+        good_size = 0
+        if os.path.exists(journal_file):
+            with open(journal_file, mode='rb') as file:
+                for line in file:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('no newline')
+                        collection, id, doc = json.loads(line)
+                    except ValueError:
+                        print('Ignoring a partially written entry at the end of the journal')
+                        break
+                    self.pending.setdefault(collection, []).append((id, doc))
+                    self.dirty.add(collection)
+                    good_size += len(line)
+                    count += 1
+            os.truncate(journal_file, good_size)
+        self.journal = open(journal_file, mode='ab', buffering=0)
+        self.journal_size = good_size
+        return count
+
+    # Converts a state.json file from older versions into per-collection snapshot files
+    def load_legacy(self) -> None:
+        print(f'Converting {legacy_file} to per-collection files in {state_dir}')
+        with open(legacy_file, mode='rb') as file:
+            packet = json.loads(file.read())
+        for name in collection_names:
+            self.__dict__[name] = RatingsTable.from_mapping(packet[name]) if name == 'ratings' else packet[name]
+            self.dirty.add(name)
+        self.snapshot()
+        os.replace(legacy_file, legacy_file + '.old')
+
+    # Flush all the caches and compact everything into snapshots
     def save(self) -> None:
         import rec
         flush_caches()
         self.put_engine(rec.engine.marshal())
-        packet = {
-            'sessions': self.sessions,
-            'accounts': self.accounts,
-            'notif_in': self.notif_in,
-            'notif_out': self.notif_out,
-            'posts': self.posts,
-            'history': self.history,
-            'user_profiles': self.user_profiles,
-            'item_profiles': self.item_profiles,
-            'ratings': self.ratings.to_mapping(),
-            'engine': self.engine,
-        }
-
-        # Write to file
-        blob = bytes(json.dumps(packet), 'utf8')
-        with open('state.json', mode='wb+') as file:
-            file.write(blob)
-
-    # Load all the data from a flat file
+        self.snapshot()
+
+    # Prepares to load collections lazily from their snapshot files
     def load(self, flush_all: bool=False) -> None:
         import rec
         if flush_all:
             print('Flushing all existing data')
-        elif not os.path.exists('state.json'):
-            print('No state.json file was found. Starting with no data.')
+            for name in collection_names:
+                self.__dict__[name] = RatingsTable() if name == 'ratings' else {}
+                self.dirty.add(name)
+            self.snapshot()
+        elif os.path.exists(legacy_file) and not os.path.exists(state_dir):
+            self.load_legacy()
+        elif not os.path.exists(state_dir):
+            print(f'No {state_dir} folder was found. Starting with no data.')
+            self.snapshot()
         else:
-            # Parse the file
-            blob = None
-            with open('state.json', mode='rb') as file:
-                blob = file.read()
-            packet = json.loads(blob)
-            self.sessions = packet['sessions']
-            self.accounts = packet['accounts']
-            self.notif_in = packet['notif_in']
-            self.notif_out = packet['notif_out']
-            self.posts = packet['posts']
-            self.history = packet['history']
-            self.user_profiles = packet['user_profiles']
-            self.item_profiles = packet['item_profiles']
-            self.ratings = IndexableDict.from_mapping(packet['ratings'])
-            rec.engine.unmarshal(packet['engine'])
+            print(f'Found {self.replay()} changes in {journal_file}')
+        if len(self.engine) > 0:
+            rec.engine.unmarshal(self.engine)
 
     # Consumes a marshaled session object (including its own '_id' field)
     def put_session(self, id: str, session: Mapping[str, Any]) -> None:
         self.sessions[id] = session
+        self.log('sessions', [(id, session)])
 
     # Consumes a session id
     # Returns a marshaled session object
     def get_session(self, id: str) -> Mapping[str, Any]:
         return self.sessions[id]
 
+    # Keeps the name index up to date when an account is put
+    def index_account_name(self, id: str, account: Mapping[str, Any]) -> None:
+        if self.account_names is None:
+            return
+        old = self.accounts.get(id)
+        if old is not None and old['name'] != account['name'] and self.account_names.get(old['name']) == id:
+            del self.account_names[old['name']]
+        self.account_names[account['name']] = id
+
     # Consumes a marshaled account object (including its own '_id' field)
     def put_account(self, id: str, account: Mapping[str, Any]) -> None:
+        self.index_account_name(id, account)
         self.accounts[id] = account
+        self.log('accounts', [(id, account)])
 
     # Consumes an account id
     # Returns a marshaled account
     def get_account(self, id: str) -> Mapping[str, Any]:
         return self.accounts[id]
 
+    # Consumes a list of (account id, marshaled account) pairs
+    def put_accounts(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        for id, doc in docs:
+            self.index_account_name(id, doc)
+            self.accounts[id] = doc
+        self.log('accounts', docs)
+
+    # Consumes a list of account ids
+    # Returns a mapping from ids to marshaled accounts. Ids that are not found are omitted.
+    def get_accounts(self, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return { id: self.accounts[id] for id in ids if id in self.accounts }
+
     # Returns true iff there are no accounts yet
     def have_no_accounts(self) -> bool:
         return len(self.accounts) == 0
@@ -104,17 +238,17 @@ class FlatFile():
     # Consumes an account name
     # Returns a marshaled account with that name if one exists
     def get_account_by_name(self, name: str) -> Mapping[str, Any]:
-        for id in self.accounts.keys():
-            account = self.accounts[id]
-            if account['name'] == name:
-                d = dict(account)
-                d['_id'] = id
-                return d
-        raise KeyError(name)
+        if self.account_names is None:
+            self.account_names = { account['name']: id for id, account in self.accounts.items() }
+        id = self.account_names[name]
+        d = dict(self.accounts[id])
+        d['_id'] = id
+        return d
 
     # Consumes an account id and a list of notifications
     def put_notif_in(self, account_id: str, doc: Mapping[str, Any]) -> None:
         self.notif_in[account_id] = doc
+        self.log('notif_in', [(account_id, doc)])
 
     # Consumes an account id
     # Returns a list of notifications
@@ -124,6 +258,7 @@ class FlatFile():
     # Consumes an account id and a list of notifications
     def put_notif_out(self, account_id: str, doc: Mapping[str, Any]) -> None:
         self.notif_out[account_id] = doc
+        self.log('notif_out', [(account_id, doc)])
 
     # Consumes an account id
     # Returns a list of notifications
@@ -133,42 +268,86 @@ class FlatFile():
     # Consumes a marshaled post object (including its own '_id' field)
     def put_post(self, id: str, doc: Mapping[str, Any]) -> None:
         self.posts[id] = doc
+        self.log('posts', [(id, doc)])
 
     # Consumes a post id
     # Returns a marshaled post object
     def get_post(self, id: str) -> Mapping[str, Any]:
         return self.posts[id]
 
+    # Consumes a list of (post id, marshaled post) pairs
+    def put_posts(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        for id, doc in docs:
+            self.posts[id] = doc
+        self.log('posts', docs)
+
+    # Consumes a list of post ids
+    # Returns a mapping from ids to marshaled posts. Ids that are not found are omitted.
+    def get_posts(self, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return { id: self.posts[id] for id in ids if id in self.posts }
+
     # Consumes a history object (including its own '_id' field for the OP post)
     def put_history(self, id: str, doc: Mapping[str, Any]) -> None:
         self.history[id] = doc
+        self.log('history', [(id, doc)])
 
     # Consumes a post id for the OP
     # Returns a history object
     def get_history(self, id: str) -> Mapping[str, Any]:
         return self.history[id]
 
+    # Consumes a list of (OP post id, history object) pairs
+    def put_histories(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        for id, doc in docs:
+            self.history[id] = doc
+        self.log('history', docs)
+
     # Consumes an account id and a list of floats
     def put_user_profile(self, id: str, doc: Mapping[str, Any]) -> None:
         self.user_profiles[id] = doc
+        self.log('user_profiles', [(id, doc)])
 
     # Consumes an account id
     # Returns a list of floats
     def get_user_profile(self, id: str) -> Mapping[str, Any]:
         return self.user_profiles[id]
 
+    # Consumes a list of (account id, profile) pairs
+    def put_user_profiles(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        for id, doc in docs:
+            self.user_profiles[id] = doc
+        self.log('user_profiles', docs)
+
+    # Consumes a list of account ids
+    # Returns a mapping from ids to profiles. Ids that are not found are omitted.
+    def get_user_profiles(self, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return { id: self.user_profiles[id] for id in ids if id in self.user_profiles }
+
     # Consumes a post id and a list of floats
     def put_item_profile(self, id: str, doc: Mapping[str, Any]) -> None:
         self.item_profiles[id] = doc
+        self.log('item_profiles', [(id, doc)])
 
     # Consumes a post id
     # Returns a list of floats
     def get_item_profile(self, id: str) -> Mapping[str, Any]:
         return self.item_profiles[id]
 
+    # Consumes a list of (post id, profile) pairs
+    def put_item_profiles(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        for id, doc in docs:
+            self.item_profiles[id] = doc
+        self.log('item_profiles', docs)
+
+    # Consumes a list of post ids
+    # Returns a mapping from ids to profiles. Ids that are not found are omitted.
+    def get_item_profiles(self, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return { id: self.item_profiles[id] for id in ids if id in self.item_profiles }
+
     # Consumes an account id, a post id, and ratings for the pair
     def put_rating(self, user: str, item: str, vals: List[float]) -> None:
-        self.ratings[f'{user},{item}'] = vals
+        self.ratings.put(user, item, vals)
+        self.log('ratings', [(f'{user},{item}', vals)])
 
     # # Updates a batch of ratings
     # def update_ratings(self, batch: List[Tuple[str, str, List[float]]]) -> None:
@@ -178,33 +357,31 @@ class FlatFile():
     # Consumes an account id and a post id
     # Returns ratings for a user-item (account-post) pair
     def get_rating(self, user: str, item: str) -> List[float]:
-        return self.ratings[f'{user},{item}']
+        return self.ratings.get(user, item)
 
     # Consumes an account id and a list of post ids
     # Returns a mapping of item ids that have ratings to the corresponding ratings
     # Items that have not been rated will not be included in the results
     def get_ratings_for_rated_items(self, user: str, item_list: List[str]) -> Mapping[str, List[float]]:
-        results: Dict[str, Any] = {}
-        for item in item_list:
-            key = f'{user},{item}'
-            if key in self.ratings:
-                results[key] = self.ratings[key]
-        return results
+        return self.ratings.get_for_user(user, item_list)
 
     # Consumes a number of samples
     # Returns that number of random [user_id, item_id, ratings] tuples
     def get_random_ratings(self, n: int) -> List[Tuple[str, str, List[float]]]:
-        results: List[Tuple[str, str, List[float]]] = []
-        for i in range(n):
-            key = self.ratings.random_key()
-            first_comma = key.index(',')
-            assert first_comma >= 0, 'malformed key'
-            results.append((key[:first_comma], key[first_comma+1:], self.ratings[key]))
-        return results
+        if len(self.ratings) == 0:
+            return []
+        return self.ratings.sample(n)
+
+    # Consumes a number of ratings per chunk
+    # Yields every rating as chunks of (user ids, item ids, ratings matrix)
+    def iter_ratings(self, chunk_size: int) -> Iterator[Tuple[List[str], List[str], np.ndarray]]:
+        for start in range(0, len(self.ratings), chunk_size):
+            yield self.ratings.columns(start, min(start + chunk_size, len(self.ratings)))
 
     # Consumes the marshaled engine object
     def put_engine(self, doc: Mapping[str, Any]) -> None:
         self.engine = doc
+        self.log('engine', [('', doc)])
 
     # Returns the marshaled engine object
     def get_engine(self) -> Mapping[str, Any]:
@@ -236,6 +413,17 @@ class Mongo():
             self.ratings.create_index([('user', 1), ('item', 1)])
         self.engine = self.db['engine']
 
+    # Upserts many documents with a single round trip
+    @staticmethod
+    def put_many(collection: Any, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        if len(docs) > 0:
+            collection.bulk_write([ pymongo.ReplaceOne({'_id': id}, doc, upsert=True) for id, doc in docs ], ordered=False)
+
+    # Finds many documents with a single round trip
+    @staticmethod
+    def get_many(collection: Any, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return { doc['_id']: doc for doc in collection.find({'_id': {'$in': ids}}) }
+
     def save(self) -> None:
         import rec
         flush_caches()
@@ -292,6 +480,15 @@ class Mongo():
             raise KeyError(id)
         return doc
 
+    # Consumes a list of (account id, marshaled account) pairs
+    def put_accounts(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        Mongo.put_many(self.accounts, docs)
+
+    # Consumes a list of account ids
+    # Returns a mapping from ids to marshaled accounts. Ids that are not found are omitted.
+    def get_accounts(self, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return Mongo.get_many(self.accounts, ids)
+
     # Consumes an account name
     # Returns a marshaled account with that name if one exists
     def get_account_by_name(self, name: str) -> Mapping[str, Any]:
@@ -353,6 +550,15 @@ class Mongo():
             raise KeyError(id)
         return doc
 
+    # Consumes a list of (post id, marshaled post) pairs
+    def put_posts(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        Mongo.put_many(self.posts, docs)
+
+    # Consumes a list of post ids
+    # Returns a mapping from ids to marshaled posts. Ids that are not found are omitted.
+    def get_posts(self, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return Mongo.get_many(self.posts, ids)
+
     # Consumes a history object (including its own '_id' field for the OP)
     def put_history(self, id: str, doc: Mapping[str, Any]) -> None:
         self.history.replace_one(
@@ -369,6 +575,10 @@ class Mongo():
             raise KeyError(id)
         return doc
 
+    # Consumes a list of (OP post id, history object) pairs
+    def put_histories(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        Mongo.put_many(self.history, docs)
+
     # Consumes an account id and a list of floats
     def put_user_profile(self, id: str, doc: Mapping[str, Any]) -> None:
         self.user_profiles.replace_one(
@@ -385,6 +595,15 @@ class Mongo():
             raise KeyError(id)
         return doc
 
+    # Consumes a list of (account id, profile) pairs
+    def put_user_profiles(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        Mongo.put_many(self.user_profiles, docs)
+
+    # Consumes a list of account ids
+    # Returns a mapping from ids to profiles. Ids that are not found are omitted.
+    def get_user_profiles(self, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return Mongo.get_many(self.user_profiles, ids)
+
     # Consumes a post id and a list of floats
     def put_item_profile(self, id: str, doc: Mapping[str, Any]) -> None:
         self.item_profiles.replace_one(
@@ -401,6 +620,15 @@ class Mongo():
             raise KeyError(id)
         return doc
 
+    # Consumes a list of (post id, profile) pairs
+    def put_item_profiles(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        Mongo.put_many(self.item_profiles, docs)
+
+    # Consumes a list of post ids
+    # Returns a mapping from ids to profiles. Ids that are not found are omitted.
+    def get_item_profiles(self, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return Mongo.get_many(self.item_profiles, ids)
+
     # Consumes an account id, a post id, and ratings for the pair
     def put_rating(self, user_id: str, item_id: str, vals: List[float]) -> None:
         self.ratings.replace_one(
@@ -452,6 +680,18 @@ class Mongo():
         cursor = self.ratings.aggregate([{'$sample': { 'size': n }}])
         return [ (doc['user'], doc['item'], doc['vals']) for doc in cursor ]
 
+    # Consumes a number of ratings per chunk
+    # Yields every rating as chunks of (user ids, item ids, ratings matrix)
+    def iter_ratings(self, chunk_size: int) -> Iterator[Tuple[List[str], List[str], np.ndarray]]:
+        chunk: List[Mapping[str, Any]] = []
+        for doc in self.ratings.find({}, {'user': 1, 'item': 1, 'vals': 1}).batch_size(chunk_size):
+            chunk.append(doc)
+            if len(chunk) >= chunk_size:
+                yield [ d['user'] for d in chunk ], [ d['item'] for d in chunk ], np.array([ d['vals'] for d in chunk ], dtype=np.float32)
+                chunk = []
+        if len(chunk) > 0:
+            yield [ d['user'] for d in chunk ], [ d['item'] for d in chunk ], np.array([ d['vals'] for d in chunk ], dtype=np.float32)
+
     # Consumes the marshaled engine object
     def put_engine(self, doc: Mapping[str, Any]) -> None:
         self.engine.replace_one(
@@ -468,9 +708,280 @@ class Mongo():
         return doc
 
 
+# A SQLite database. Each document is stored as JSON text in a table keyed by its id.
+class SQLite():
+    doc_tables = [ 'sessions', 'notif_in', 'notif_out', 'posts', 'history', 'user_profiles', 'item_profiles', 'engine' ]
+    max_vars = 500 # Max ids to put in one "IN (...)" clause
+
+    def __init__(self, filename: str) -> None:
+        # The sqlite3 module keeps a cache of prepared statements, so each constant SQL string below is only compiled once
+        self.conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False, cached_statements=256)
+        self.lock = threading.RLock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for table in SQLite.doc_tables:
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, doc TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS accounts (id TEXT PRIMARY KEY, name TEXT NOT NULL, doc TEXT NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS accounts_name ON accounts (name)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS ratings (rowid INTEGER PRIMARY KEY, user TEXT NOT NULL, item TEXT NOT NULL, vals TEXT NOT NULL)')
+        self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS ratings_user_item ON ratings (user, item)')
+
+    # Runs one statement for each row of parameters in a single transaction
+    def execute_many(self, sql: str, rows: List[Tuple[Any, ...]]) -> None:
+        if len(rows) == 0:
+            return
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany(sql, rows)
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    # Runs a query and returns all the resulting rows
+    def query(self, sql: str, params: Tuple[Any, ...]) -> List[Any]:
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    # Upserts a document
+    def put_doc(self, table: str, id: str, doc: Any) -> None:
+        with self.lock:
+            self.conn.execute(f'INSERT OR REPLACE INTO {table} (id, doc) VALUES (?, ?)', (id, json.dumps(doc)))
+
+    # Upserts many documents in one transaction
+    def put_docs(self, table: str, docs: List[Tuple[str, Any]]) -> None:
+        self.execute_many(f'INSERT OR REPLACE INTO {table} (id, doc) VALUES (?, ?)', [ (id, json.dumps(doc)) for id, doc in docs ])
+
+    # Finds a document. Raises KeyError if it is not found.
+    def get_doc(self, table: str, id: str) -> Any:
+        rows = self.query(f'SELECT doc FROM {table} WHERE id = ?', (id,))
+        if len(rows) == 0:
+            raise KeyError(id)
+        return json.loads(rows[0][0])
+
+    # Finds many documents. Ids that are not found are omitted.
+    def get_docs(self, table: str, ids: List[str]) -> Mapping[str, Any]:
+        results: Dict[str, Any] = {}
+        for start in range(0, len(ids), SQLite.max_vars):
+            chunk = ids[start:start + SQLite.max_vars]
+            rows = self.query(f'SELECT id, doc FROM {table} WHERE id IN ({",".join("?" * len(chunk))})', tuple(chunk))
+            for id, doc in rows:
+                results[id] = json.loads(doc)
+        return results
+
+    def save(self) -> None:
+        import rec
+        flush_caches()
+        self.put_engine(rec.engine.marshal())
+        with self.lock:
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def load(self, flush_all: bool=False) -> None:
+        if flush_all:
+            print('Flushing all existing data')
+            with self.lock:
+                for table in SQLite.doc_tables + [ 'accounts', 'ratings' ]:
+                    self.conn.execute(f'DELETE FROM {table}')
+        import rec
+        try:
+            rec.engine.unmarshal(self.get_engine())
+        except KeyError:
+            print('The database is empty. Starting with no data.')
+
+    # Consumes a marshaled session object (including its own '_id' field)
+    def put_session(self, id: str, doc: Mapping[str, Any]) -> None:
+        self.put_doc('sessions', id, doc)
+
+    # Consumes a session id
+    # Returns a marshaled session object
+    def get_session(self, id: str) -> Mapping[str, Any]:
+        return cast(Mapping[str, Any], self.get_doc('sessions', id))
+
+    # Consumes a marshaled account object (including its own '_id' field)
+    def put_account(self, id: str, doc: Mapping[str, Any]) -> None:
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO accounts (id, name, doc) VALUES (?, ?, ?)', (id, doc['name'], json.dumps(doc)))
+
+    # Consumes an account id
+    # Returns a marshaled account
+    def get_account(self, id: str) -> Mapping[str, Any]:
+        return cast(Mapping[str, Any], self.get_doc('accounts', id))
+
+    # Consumes a list of (account id, marshaled account) pairs
+    def put_accounts(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        self.execute_many('INSERT OR REPLACE INTO accounts (id, name, doc) VALUES (?, ?, ?)', [ (id, doc['name'], json.dumps(doc)) for id, doc in docs ])
+
+    # Consumes a list of account ids
+    # Returns a mapping from ids to marshaled accounts. Ids that are not found are omitted.
+    def get_accounts(self, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return self.get_docs('accounts', ids)
+
+    # Consumes an account name
+    # Returns a marshaled account with that name if one exists
+    def get_account_by_name(self, name: str) -> Mapping[str, Any]:
+        rows = self.query('SELECT id, doc FROM accounts WHERE name = ? LIMIT 1', (name,))
+        if len(rows) == 0:
+            raise KeyError(name)
+        d = json.loads(rows[0][1])
+        d['_id'] = rows[0][0]
+        return cast(Mapping[str, Any], d)
+
+    # Returns true iff there are no accounts yet
+    def have_no_accounts(self) -> bool:
+        return len(self.query('SELECT 1 FROM accounts LIMIT 1', ())) == 0
+
+    # Consumes an account id and a list of notifications
+    def put_notif_in(self, id: str, doc: Mapping[str, Any]) -> None:
+        self.put_doc('notif_in', id, doc)
+
+    # Consumes an account id
+    # Returns a list of notifications
+    def get_notif_in(self, account_id: str) -> Mapping[str, Any]:
+        return cast(Mapping[str, Any], self.get_doc('notif_in', account_id))
+
+    # Consumes an account id and a list of notifications
+    def put_notif_out(self, id: str, doc: Mapping[str, Any]) -> None:
+        self.put_doc('notif_out', id, doc)
+
+    # Consumes an account id
+    # Returns a list of notifications
+    def get_notif_out(self, account_id: str) -> Mapping[str, Any]:
+        return cast(Mapping[str, Any], self.get_doc('notif_out', account_id))
+
+    # Consumes a marshaled post object (including its own '_id' field)
+    def put_post(self, id: str, doc: Mapping[str, Any]) -> None:
+        self.put_doc('posts', id, doc)
+
+    # Consumes a post id
+    # Returns a marshaled post object
+    def get_post(self, id: str) -> Mapping[str, Any]:
+        return cast(Mapping[str, Any], self.get_doc('posts', id))
+
+    # Consumes a list of (post id, marshaled post) pairs
+    def put_posts(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        self.put_docs('posts', docs)
+
+    # Consumes a list of post ids
+    # Returns a mapping from ids to marshaled posts. Ids that are not found are omitted.
+    def get_posts(self, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return self.get_docs('posts', ids)
+
+    # Consumes a history object (including its own '_id' field for the OP)
+    def put_history(self, id: str, doc: Mapping[str, Any]) -> None:
+        self.put_doc('history', id, doc)
+
+    # Consumes a post id for the OP
+    # Returns a marshaled history object
+    def get_history(self, id: str) -> Mapping[str, Any]:
+        return cast(Mapping[str, Any], self.get_doc('history', id))
+
+    # Consumes a list of (OP post id, history object) pairs
+    def put_histories(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        self.put_docs('history', docs)
+
+    # Consumes an account id and a list of floats
+    def put_user_profile(self, id: str, doc: Mapping[str, Any]) -> None:
+        self.put_doc('user_profiles', id, doc)
+
+    # Consumes an account id
+    # Returns a list of floats
+    def get_user_profile(self, id: str) -> Mapping[str, Any]:
+        return cast(Mapping[str, Any], self.get_doc('user_profiles', id))
+
+    # Consumes a list of (account id, profile) pairs
+    def put_user_profiles(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        self.put_docs('user_profiles', docs)
+
+    # Consumes a list of account ids
+    # Returns a mapping from ids to profiles. Ids that are not found are omitted.
+    def get_user_profiles(self, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return self.get_docs('user_profiles', ids)
+
+    # Consumes a post id and a list of floats
+    def put_item_profile(self, id: str, doc: Mapping[str, Any]) -> None:
+        self.put_doc('item_profiles', id, doc)
+
+    # Consumes a post id
+    # Returns a list of floats
+    def get_item_profile(self, id: str) -> Mapping[str, Any]:
+        return cast(Mapping[str, Any], self.get_doc('item_profiles', id))
+
+    # Consumes a list of (post id, profile) pairs
+    def put_item_profiles(self, docs: List[Tuple[str, Mapping[str, Any]]]) -> None:
+        self.put_docs('item_profiles', docs)
+
+    # Consumes a list of post ids
+    # Returns a mapping from ids to profiles. Ids that are not found are omitted.
+    def get_item_profiles(self, ids: List[str]) -> Mapping[str, Mapping[str, Any]]:
+        return self.get_docs('item_profiles', ids)
+
+    # Consumes an account id, a post id, and ratings for the pair
+    # (Updating in place keeps the rowid, so rowids stay dense for get_random_ratings.)
+    def put_rating(self, user_id: str, item_id: str, vals: List[float]) -> None:
+        with self.lock:
+            self.conn.execute('INSERT INTO ratings (user, item, vals) VALUES (?, ?, ?) ON CONFLICT (user, item) DO UPDATE SET vals = excluded.vals', (user_id, item_id, json.dumps(vals)))
+
+    # Consumes an account id and a post id
+    # Returns ratings for a user-item (account-post) pair
+    def get_rating(self, user: str, item: str) -> List[float]:
+        rows = self.query('SELECT vals FROM ratings WHERE user = ? AND item = ?', (user, item))
+        if len(rows) == 0:
+            raise KeyError(f'{user},{item}')
+        return cast(List[float], json.loads(rows[0][0]))
+
+    # Consumes an account id and a list of post ids
+    # Returns a mapping of item ids that have ratings to the corresponding ratings
+    # Items that have not been rated will not be included in the results
+    def get_ratings_for_rated_items(self, user: str, item_list: List[str]) -> Mapping[str, List[float]]:
+        results: Dict[str, List[float]] = {}
+        for start in range(0, len(item_list), SQLite.max_vars):
+            chunk = item_list[start:start + SQLite.max_vars]
+            rows = self.query(f'SELECT item, vals FROM ratings WHERE user = ? AND item IN ({",".join("?" * len(chunk))})', (user, *chunk))
+            for item, vals in rows:
+                results[item] = json.loads(vals)
+        return results
+
+    # Consumes a number of samples
+    # Returns that number of random [user_id, item_id, ratings] tuples
+    def get_random_ratings(self, n: int) -> List[Tuple[str, str, List[float]]]:
+        results: List[Tuple[str, str, List[float]]] = []
+        max_rowid = self.query('SELECT MAX(rowid) FROM ratings', ())[0][0]
+        if max_rowid is None:
+            return results
+        while len(results) < n:
+            picks = [ random.randint(1, max_rowid) for _ in range(min(n - len(results), SQLite.max_vars)) ]
+            rows = self.query(f'SELECT rowid, user, item, vals FROM ratings WHERE rowid IN ({",".join("?" * len(picks))})', tuple(picks))
+            found = { row[0]: (row[1], row[2], json.loads(row[3])) for row in rows }
+            results += [ found[rowid] for rowid in picks if rowid in found ]
+        return results
+
+    # Consumes a number of ratings per chunk
+    # Yields every rating as chunks of (user ids, item ids, ratings matrix)
+    def iter_ratings(self, chunk_size: int) -> Iterator[Tuple[List[str], List[str], np.ndarray]]:
+        last_rowid = 0
+        while True:
+            rows = self.query('SELECT rowid, user, item, vals FROM ratings WHERE rowid > ? ORDER BY rowid LIMIT ?', (last_rowid, chunk_size))
+            if len(rows) == 0:
+                break
+            last_rowid = rows[-1][0]
+            yield [ row[1] for row in rows ], [ row[2] for row in rows ], np.array([ json.loads(row[3]) for row in rows ], dtype=np.float32)
+
+    # Consumes the marshaled engine object
+    def put_engine(self, doc: Mapping[str, Any]) -> None:
+        self.put_doc('engine', '0', doc)
+
+    # Returns the marshaled engine object
+    def get_engine(self) -> Mapping[str, Any]:
+        return cast(Mapping[str, Any], self.get_doc('engine', '0'))
+
+
 if config['use_mongo']:
     print("Using Mongo for the database")
     db: Any = Mongo()
+elif config['use_sqlite']:
+    print("Using SQLite for the database")
+    db = SQLite(cast(str, config['sqlite_file']))
 else:
     print("Using a flat file for the database")
     db = FlatFile()
@@ -10,55 +10,84 @@ import traceback
 import posts
 import history
 import notifs
+import cache
+import time
+import numpy as np
+from collections import OrderedDict
+from config import config
 from PIL import Image
 
 # Load the feed page
-with open('feed.html') as f:
-    lines = f.readlines()
-    feed_page = ''.join(lines)
+feed_prefix, feed_suffix = webserver.load_template('feed.html')
 
-# Finds the index of the strongest rating, and computes an overall score for the item
-def compute_score(ratings: List[float]) -> Tuple[int, float]:
-    assert len(ratings) == len(rec.rating_choices), 'expected a rating for each choice'
-    max_index = 0
-    max_val = -1000000.
-    score = 0.
-    for i in range(len(rec.rating_choices)):
-        score += ratings[i] * rec.rating_choices[i][0]
-        if ratings[i] > max_val:
-            max_val = ratings[i]
-            max_index = i
-    return max_index, score
+# Finds the index of the strongest rating in each row of an (n, len(rec.rating_choices)) matrix,
+# and computes an overall score for each row (the sum of its ratings weighted by the sign of each choice).
+# Rows flagged in never_rated, and rows of NaN (no prediction), get index 0 and a score of 1000.
+def compute_scores(ratings: np.ndarray, never_rated: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    assert ratings.shape[1:] == (len(rec.rating_choices),), 'expected a rating for each choice'
+    unscored = np.isnan(ratings[:, 0])
+    if never_rated is not None:
+        unscored |= never_rated
+    filled = np.where(unscored[:, None], 0., ratings)
+    indexes = np.argmax(filled, axis=1)
+    scores = np.matmul(filled, rec.rating_signs)
+    indexes[unscored] = 0
+    scores[unscored] = 1000.
+    return indexes, scores
 
-# Returns aioff index, aion index, aioff score, and aion score for a particular node and user.
-def compute_scores(item_ratings_count: int, aioff_ratings: List[float], aion_ratings: List[float]) -> Tuple[int, int, float, float]:
-    if item_ratings_count < 1:
-        return 0, 0, 1000., 1000. # This item has never been rated
-    max_aioff_index, aioff_score = compute_score(aioff_ratings)
-    if len(aion_ratings) == 0:
-        max_aion_index = 0
-        aion_score = 1000.
-    else:
-        max_aion_index, aion_score = compute_score(aion_ratings)
-    return max_aioff_index, max_aion_index, aioff_score, aion_score
+# Computes the aioff index and aioff score for any of these posts whose ratings changed since they were last computed
+def update_aioff_scores(post_list: List[posts.Post]) -> None:
+    stale = [ post for post in post_list if post.aioff_score is None ]
+    if len(stale) == 0:
+        return
+    indexes, scores = compute_scores(np.array([ post.get_aioff_ratings()[0] for post in stale ]), np.array([ post.rating_count < 1 for post in stale ]))
+    for post, index, score in zip(stale, indexes.tolist(), scores.tolist()):
+        post.aioff_score = (index, score)
+
+# Maps account ids to (published engine version, the account's profile, { post id: (aion index, aion score) }).
+# An account's scores are discarded when a new model is published, when its own profile changes, or when it rates a post.
+aion_score_cache: 'OrderedDict[str, Tuple[int, bytes, Dict[str, Tuple[int, float]]]]' = OrderedDict()
+aion_score_cache_max_accounts = 1000
+aion_score_cache_max_posts = 10000 # per account
+
+# Returns the aion index and aion score of each post for an account, predicting only the ones that are not cached.
+# (The score is 1000 if the recommender has no data for the post.)
+def get_aion_scores(account_id: str, post_ids: List[str]) -> List[Tuple[int, float]]:
+    version = rec.engine.published_version()
+    row = rec.engine.user_profiles.rows.get(account_id, -1)
+    profile = rec.engine.user_profiles.matrix[row].tobytes() if row >= 0 else b''
+    entry = aion_score_cache.get(account_id)
+    if entry is None or entry[0] != version or entry[1] != profile or len(entry[2]) > aion_score_cache_max_posts:
+        entry = (version, profile, {})
+        aion_score_cache[account_id] = entry
+        if len(aion_score_cache) > aion_score_cache_max_accounts:
+            aion_score_cache.popitem(last=False)
+    aion_score_cache.move_to_end(account_id)
+    scores = entry[2]
+    missing = [ post_id for post_id in dict.fromkeys(post_ids) if not post_id in scores ]
+    if len(missing) > 0:
+        indexes, aion_scores = compute_scores(rec.engine.get_ratings(account_id, missing))
+        scores.update(zip(missing, zip(indexes.tolist(), aion_scores.tolist())))
+    return [ scores[post_id] for post_id in post_ids ]
 
 # Attaches rating statistics to the updates
 def annotate_updates(updates: List[Dict[str, Any]], account: accounts.Account) -> None:
-    post_ids = [ up['id'] for up in updates if (up['act'] == 'add' or up['act'] == 'rate') ]
+    rated_updates = [ up for up in updates if (up['act'] == 'add' or up['act'] == 'rate') ]
+    post_ids = [ up['id'] for up in rated_updates ]
     if len(post_ids) == 0:
         return
-    aioff_ratings: List[List[float]] = []
-    ratings_counts: List[int] = []
-    for post_id in post_ids:
-        post = posts.post_cache[post_id]
-        ur, count = post.get_aioff_ratings()
-        aioff_ratings.append(ur)
-        ratings_counts.append(count)
-    aion_ratings = rec.engine.get_ratings(account.id, post_ids)
-    new_item_threshold = 3 # Number of ratings before an item is no longer considered "new"
-    for up, c, ur, br in zip(updates, ratings_counts, aioff_ratings, aion_ratings):
-        # Compute aioff index, aion index, aioff score, and aion score for this update and user
-        up['ui'], up['bi'], up['us'], up['bs'] = compute_scores(c, ur, br)
+    post_map = posts.post_cache.get_many(post_ids)
+    update_aioff_scores(list(post_map.values()))
+    aion_scores = get_aion_scores(account.id, post_ids)
+    for up, (aion_index, aion_score) in zip(rated_updates, aion_scores):
+        # Attach aioff index, aion index, aioff score, and aion score for this update and user
+        post = post_map[up['id']]
+        assert post.aioff_score is not None
+        up['ui'], up['us'] = post.aioff_score
+        if post.rating_count < 1:
+            up['bi'], up['bs'] = 0, 1000. # This item has never been rated
+        else:
+            up['bi'], up['bs'] = aion_index, aion_score
 
 
 tag_whitelist = set([
@@ -140,8 +169,16 @@ def delete_post(post_id: str) -> None:
     par = posts.post_cache[post.parent_id]
     index = par.children.index(post_id)
     del par.children[index]
+    posts.post_cache.set_modified(par.id)
     if len(post.op_id) > 0:
-        history.rewrite_op_history(post.op_id)
+        # Remove the replies under it too, so their adds are no longer sent
+        removed_ids: List[str] = []
+        stack = [ post_id ]
+        while len(stack) > 0:
+            id = stack.pop()
+            removed_ids.append(id)
+            stack += posts.post_cache[id].children
+        history.record_changes(post.op_id, [], removed_ids)
     # todo: recursively remove the post and all its children from the database
 
 # Recursively adds a whole branch of categories to the updates
@@ -210,18 +247,62 @@ def add_updates(updates: List[Dict[str, Any]], incoming_packet: Mapping[str, Any
                 op_hist = history.history_cache[op_id]
             except KeyError:
                 break
-            op_revs[i] = max(op_revs[i], op_hist.start)
-            while op_revs[i] < op_hist.revs():
-                post_id = op_hist.get_rev(op_revs[i])
-                post = posts.post_cache[post_id]
-                updates.append(post.encode_for_client(account_id, depth))
-                op_revs[i] += 1
-                patience -= 1
-                if patience == 0:
-                    break
+            op_revs[i] = op_hist.resume_rev(op_revs[i])
+            n = max(0, min(op_hist.revs() - op_revs[i], patience))
+            revisions = [ (op_hist.get_rev(op_revs[i] + j), op_hist.get_kind(op_revs[i] + j)) for j in range(n) ]
+            revisions = [ (id, kind) for id, kind in revisions if kind == history.REMOVE or not id in op_hist.removed ]
+            post_ids = [ id for id, _ in revisions ]
+            kinds = [ kind for _, kind in revisions ]
+            post_map = posts.post_cache.get_many(post_ids)
+            posts.prefetch_for_client([ post_map[id] for id, kind in zip(post_ids, kinds) if kind != history.REMOVE ])
+            for post_id, kind in zip(post_ids, kinds):
+                if kind == history.REMOVE:
+                    updates.append({ 'act': 'rm', 'id': post_id, 'par': post_map[post_id].parent_id })
+                else:
+                    updates.append(post_map[post_id].encode_for_client(account_id, depth))
+            op_revs[i] += n
+            patience -= n
 
     return rev, op_list, op_revs
 
+# Returns true iff add_updates would find something new for the client,
+# or the client's notification count is out of date.
+# This is much cheaper than add_updates, so it is used to decide when to wake up a waiting client.
+def have_updates(incoming_packet: Mapping[str, Any], account_id: str) -> bool:
+    if incoming_packet['rev'] < 1:
+        return True
+    try:
+        notif_in = notifs.notif_in_cache[account_id]
+        if len(notif_in.notifs) != incoming_packet['nc']:
+            return True
+    except KeyError:
+        if incoming_packet['nc'] != 0:
+            return True
+    category = posts.post_cache[incoming_packet['post']]
+    while category.type != 'cat':
+        category = posts.post_cache[category.parent_id]
+    if len(category.children) == 0 or posts.post_cache[category.children[0]].type == 'op':
+        for op_id, op_rev in zip(incoming_packet['ops'], incoming_packet['opr']):
+            try:
+                op_hist = history.history_cache[op_id]
+            except KeyError:
+                break
+            if op_hist.resume_rev(op_rev) < op_hist.revs():
+                return True
+    return False
+
+# Parks the request until there are updates for the client or the time limit expires.
+# (Must be called while holding cache.lock. The lock is released while waiting.)
+def wait_for_updates(incoming_packet: Mapping[str, Any], account_id: str) -> None:
+    if config['server_mode'] == 'single':
+        return # Waiting would block every other client
+    deadline = time.monotonic() + cast(float, config['long_poll_timeout'])
+    while not have_updates(incoming_packet, account_id):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0.:
+            break
+        cache.changed.wait(remaining)
+
 # Loads an incoming image from a temp file,
 # scales it down (if necessary),
 # and saves it to a better location for long-term storage.
@@ -246,12 +327,15 @@ def do_ajax(incoming_packet: Mapping[str, Any], session: sessions.Session) -> Di
         act = incoming_packet['act']
         if act == 'update': # Just get updates
             pass
+        elif act == 'wait': # Get updates as soon as there are any (long-poll)
+            wait_for_updates(incoming_packet, account.id)
         elif act == 'react': # React to a post
             post = posts.post_cache[incoming_packet['id']]
             emo = incoming_packet['emo']
             if emo < 0 or emo >= 12:
                 raise ValueError('out of range emoticon index')
-            post.emos.append((emo, account.name))
+            post.add_emo(emo, account.name)
+            posts.post_cache.set_modified(post.id)
             notifs.notify(post.account_id, f'react_{emo}', post.id, account.id)
             updates.append({
                 'act': 'emo',
@@ -268,6 +352,7 @@ def do_ajax(incoming_packet: Mapping[str, Any], session: sessions.Session) -> Di
                 })
             else:
                 rec.engine.rate(account.id, incoming_packet['id'], incoming_packet['ratings'])
+                aion_score_cache.pop(account.id, None) # (Its own ratings override the predictions)
                 updates.append({
                     'act': 'rate',
                     'id': incoming_packet['id'],
@@ -350,8 +435,9 @@ def do_ajax(incoming_packet: Mapping[str, Any], session: sessions.Session) -> Di
             assert pod.type == 'pod', 'not a pod'
             if len(pod.wl) == 1 and not account.id in pod.wl:
                 pod.wl.append(account.id)
-                history.rewrite_op_history(pod.op_id)
-                history.history_cache.set_modified(pod.op_id)
+                posts.post_cache.set_modified(pod_id)
+                posts.invalidate_encodings() # (The replies in this debate may now be indented differently)
+                history.record_changes(pod.op_id, [ pod_id ] + pod.children, [])
                 assert len(pod.parent_id) > 0, 'invalid parent id'
                 opponent_account = accounts.account_cache[pod.wl[0]]
                 notifs.notify(opponent_account.id, 'acc', pod.op_id, account.id)
@@ -440,22 +526,27 @@ def do_ajax(incoming_packet: Mapping[str, Any], session: sessions.Session) -> Di
             'updates': updates,
         }
 
-def pick_ops(post: str) -> List[str]:
+# Chooses the OPs to show in a category.
+# If the account has the AI on, the recommender picks them. Otherwise, they are the newest ones.
+def pick_ops(post: str, account: accounts.Account) -> List[str]:
     op_list: List[str] = []
     node = posts.post_cache[post]
     is_leaf_cat = (node.type == 'cat' and (len(node.children) == 0 or posts.post_cache[node.children[0]].type == 'op'))
     if is_leaf_cat and len(node.children) > 0:
+        if account.ai_on:
+            return rec.engine.recommend(account.id, post, node.children, 6)
         for i in reversed(range(len(node.children))):
             op_list.append(node.children[i])
             if len(op_list) >= 6:
                 break
     return op_list
 
-def do_feed(query: Mapping[str, Any], session: sessions.Session) -> str:
+def do_feed(query: Mapping[str, Any], session: sessions.Session) -> List[bytes]:
     session.query = query
+    sessions.session_cache.set_modified(session.id)
     account = accounts.active_account(session)
     post = query['post'] if 'post' in query else '000000000000'
-    op_list = pick_ops(post)
+    op_list = pick_ops(post, account)
     globals = [
         'let session_id = \'', session.id, '\';\n',
         'let post = "', post, '";\n',
@@ -470,6 +561,6 @@ def do_feed(query: Mapping[str, Any], session: sessions.Session) -> str:
         'let rating_descr = ', str([ x[2] for x in rec.rating_choices ]), ';\n',
         'let initial_ai_on = ', 'true' if account.ai_on else 'false', ';\n',
         'let initial_thresh = ', str(account.thresh), ';\n',
+        'let long_poll = ', 'false' if config['server_mode'] == 'single' else 'true', ';\n',
     ]
-    updated_feed_page = feed_page.replace('//<globals>//', ''.join(globals), 1)
-    return updated_feed_page
+    return [ feed_prefix, bytes(''.join(globals), 'utf8'), feed_suffix ]
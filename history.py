@@ -1,23 +1,44 @@
-from typing import Mapping, Any, List, Dict, Tuple
+from typing import Mapping, Any, List, Dict, Tuple, Set, cast
 from db import db
+from config import config
 import cache
 
+# The kinds of revisions
+ADD = 'a' # A new post
+UPDATE = 'u' # A change to a post the client may already have
+REMOVE = 'r' # A post was taken out of the tree
+
+# The log of changes to the posts under an OP.
+# Clients remember how many revisions they have seen, and are sent the ones after that.
+# When the log holds too many updates and removals, it is compacted into one add for each post still in the tree.
+# Clients that had not caught up before the compaction start over at the compacted log, and the others carry on.
+# Adds and updates for removed posts are skipped, so clients never receive them after the removal.
 class History():
     def __init__(self) -> None:
-        self.start = 0
+        self.start = 0 # The revision number of the first entry in post_ids
+        self.base = 0 # Clients that have seen fewer revisions than this start over at 'start'
         self.post_ids: List[str] = []
+        self.kinds: List[str] = [] # The kind of each revision (parallel to post_ids)
+        self.deltas = 0 # The number of updates and removals in the log
+        self.removed: Set[str] = set() # The posts with a removal in the log (Not saved. Rebuilt from kinds.)
 
     def marshal(self) -> Mapping[str, Any]:
         return {
             'start': self.start,
+            'base': self.base,
             'posts': self.post_ids,
+            'kinds': ''.join(self.kinds),
         }
 
     @staticmethod
     def unmarshal(ob: Mapping[str, Any]) -> 'History':
         hist = History()
         hist.start = ob['start']
+        hist.base = ob.get('base', hist.start)
         hist.post_ids = ob['posts']
+        hist.kinds = list(ob.get('kinds', ADD * len(hist.post_ids)))
+        hist.deltas = len(hist.kinds) - hist.kinds.count(ADD)
+        hist.removed = { id for id, kind in zip(hist.post_ids, hist.kinds) if kind == REMOVE }
         return hist
 
     # Returns the number of revisions
@@ -28,9 +49,48 @@ class History():
     def get_rev(self, i: int) -> str:
         return self.post_ids[i - self.start]
 
+    # Returns the kind of the specified revision number
+    def get_kind(self, i: int) -> str:
+        return self.kinds[i - self.start]
+
+    # Returns the revision number a client that has seen 'rev' revisions should continue from
+    def resume_rev(self, rev: int) -> int:
+        return self.start if rev < self.base else rev
+
+    def append(self, id: str, kind: str) -> None:
+        self.post_ids.append(id)
+        self.kinds.append(kind)
+        if kind != ADD:
+            self.deltas += 1
+        if kind == REMOVE:
+            self.removed.add(id)
+        cache.notify_changed()
+
     # Add a post to the historical record
     def on_post(self, id: str) -> None:
-        self.post_ids.append(id)
+        self.append(id, ADD)
+
+    # Record that a post changed in a way clients need to see
+    def on_update(self, id: str) -> None:
+        self.append(id, UPDATE)
+
+    # Record that a post was removed from the tree.
+    # (Posts under it should be removed too, so their adds are skipped as well.)
+    def on_remove(self, id: str) -> None:
+        self.append(id, REMOVE)
+
+    # Replaces the log with one add for each post in the tree under the OP, parents first.
+    # Revision numbers keep counting up from where they were, so clients that have seen everything get nothing new.
+    # (Clients that were behind get the whole compacted log, so posts removed since they last caught up stay on their screens until they reload.)
+    def compact(self, op_id: str) -> None:
+        end = self.revs()
+        self.post_ids = []
+        self.kinds = []
+        self.deltas = 0
+        self.removed = set()
+        self.reconstruct_history_recursive(op_id)
+        self.start = end - len(self.post_ids)
+        self.base = end
 
     def reconstruct_history_recursive(self, post_id: str) -> None:
         import posts
@@ -45,13 +105,22 @@ def fetch_history(id: str) -> History:
 def store_history(id: str, hist: History) -> None:
     db.put_history(id, hist.marshal())
 
-history_cache: cache.Cache[str,History] = cache.Cache(100, fetch_history, store_history)
+def store_histories(items: List[Tuple[str, History]]) -> None:
+    db.put_histories([ (id, hist.marshal()) for id, hist in items ])
+
+history_cache: cache.Cache[str,History] = cache.Cache(100, fetch_history, store_history, 'history', put_many_func=store_histories)
 
 
-# Reconstruct the history of an OP so that changes to an existing node will be received.
-# (Note: This will cause everyone to download the OP and all its children again.)
-def rewrite_op_history(op_id: str) -> None:
+# Records changes to existing posts under an OP, so clients that already have them will receive them.
+# Updated posts are sent again, and removed posts are taken off the clients' screens (and never sent again).
+# Compacts the log when it holds too many of these.
+def record_changes(op_id: str, updated_ids: List[str], removed_ids: List[str]) -> None:
     hist = history_cache[op_id]
-    hist.start = hist.start + len(hist.post_ids)
-    hist.post_ids = []
-    hist.reconstruct_history_recursive(op_id)
+    for id in updated_ids:
+        hist.on_update(id)
+    for id in removed_ids:
+        hist.on_remove(id)
+    if hist.deltas > cast(int, config['history_max_deltas']):
+        hist.compact(op_id)
+    history_cache.set_modified(op_id)
+    cache.notify_changed()
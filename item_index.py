@@ -0,0 +1,125 @@
+from typing import List, Optional, cast
+import numpy as np
+from profile_table import ProfileTable
+
+BLOCK_SIZE = 4096 # Profiles scored per matmul
+TRAINING_SAMPLES_PER_LIST = 64 # The centroids are trained on a sample of about this many profiles per inverted list
+
+# Returns the positions of the k largest scores, best first
+def top_positions(scores: np.ndarray, k: int) -> np.ndarray:
+    if k < len(scores):
+        best = np.argpartition(-scores, k - 1)[:k]
+    else:
+        best = np.arange(len(scores))
+    return cast(np.ndarray, best[np.argsort(-scores[best], kind='stable')])
+
+# Finds the items (from a list of candidate ids) whose profiles have the largest dot product with a query vector.
+# Items are identified by their position in the candidate list.
+# Candidates without a profile are skipped until one appears in the profile table.
+# With up to exact_max profiled items, every one is scored in blocks of BLOCK_SIZE.
+# Beyond that, the profiles are clustered into about sqrt(n) inverted lists (IVF),
+# and only the items in the 'probes' lists whose centroids score highest against the query are scored.
+# (Profile rows never move, so the index only stores rows and always scores the current profiles.)
+class ItemIndex():
+    def __init__(self, profiles: ProfileTable, exact_max: int, probes: int) -> None:
+        self.profiles = profiles
+        self.exact_max = exact_max
+        self.probes = probes
+        self.ids: List[str] = [] # The candidate ids
+        self.rows = np.zeros([0], dtype=np.int64) # The profile row for each candidate, or -1
+        self.profiled = np.zeros([0], dtype=np.int64) # Positions of candidates that have a profile
+        self.unprofiled: List[int] = [] # Positions of candidates that had no profile
+        self.centroids: Optional[np.ndarray] = None # (Only used when there are too many items for an exact search)
+        self.lists: List[np.ndarray] = [] # Positions of the items assigned to each centroid
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    # Brings the index up to date with the candidate list.
+    # Appended candidates are added incrementally. Any other change rebuilds the index.
+    def update(self, ids: List[str]) -> None:
+        if ids != self.ids:
+            if len(ids) < len(self.ids) or ids[:len(self.ids)] != self.ids:
+                self.ids = []
+                self.rows = np.zeros([0], dtype=np.int64)
+                self.profiled = np.zeros([0], dtype=np.int64)
+                self.unprofiled = []
+                self.centroids = None
+                self.lists = []
+            start = len(self.ids)
+            new_rows = self.profiles.find_many(ids[start:])
+            self.ids = list(ids)
+            self.rows = np.concatenate([ self.rows, new_rows ])
+            self.unprofiled += [ start + i for i in np.flatnonzero(new_rows < 0).tolist() ]
+            self.add_to_lists([ start + i for i in np.flatnonzero(new_rows >= 0).tolist() ])
+
+        # Pick up profiles for candidates that have been rated since they were indexed.
+        # (Only resident profiles are checked, so this never goes to the database.)
+        if len(self.unprofiled) > 0:
+            found: List[int] = []
+            still_unprofiled: List[int] = []
+            for pos in self.unprofiled:
+                row = self.profiles.rows.get(self.ids[pos], -1)
+                if row >= 0:
+                    self.rows[pos] = row
+                    found.append(pos)
+                else:
+                    still_unprofiled.append(pos)
+            self.unprofiled = still_unprofiled
+            self.add_to_lists(found)
+
+    # Assigns newly profiled items to inverted lists, or builds the lists once there are too many items to score exactly
+    def add_to_lists(self, positions: List[int]) -> None:
+        if len(positions) == 0:
+            return
+        new_positions = np.array(positions, dtype=np.int64)
+        self.profiled = np.concatenate([ self.profiled, new_positions ])
+        if self.centroids is None:
+            if len(self.profiled) > self.exact_max:
+                self.build_lists()
+            return
+        assignments = self.nearest_centroids(self.profiles.gather(self.rows[new_positions]))
+        for c in np.unique(assignments).tolist():
+            self.lists[c] = np.concatenate([ self.lists[c], new_positions[assignments == c] ])
+
+    # Returns the index of the nearest centroid to each profile
+    def nearest_centroids(self, vecs: np.ndarray) -> np.ndarray:
+        assert self.centroids is not None
+        half_norms = 0.5 * np.sum(self.centroids * self.centroids, axis=1)
+        return np.concatenate([ np.argmax(np.matmul(vecs[start:start + BLOCK_SIZE], self.centroids.T) - half_norms, axis=1) for start in range(0, len(vecs), BLOCK_SIZE) ])
+
+    # Clusters the profiled items with a few rounds of k-means on a sample, then assigns every item to its nearest centroid
+    def build_lists(self) -> None:
+        n_lists = max(1, int(np.sqrt(len(self.profiled))))
+        sample = self.profiles.gather(self.rows[np.random.choice(self.profiled, min(len(self.profiled), n_lists * TRAINING_SAMPLES_PER_LIST), replace=False)])
+        self.centroids = sample[:n_lists].copy()
+        for _ in range(8):
+            assignments = self.nearest_centroids(sample)
+            counts = np.bincount(assignments, minlength=n_lists)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, sample)
+            nonempty = counts > 0
+            self.centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        assignments = self.nearest_centroids(self.profiles.gather(self.rows[self.profiled]))
+        order = np.argsort(assignments, kind='stable')
+        self.lists = np.split(self.profiled[order], np.cumsum(np.bincount(assignments, minlength=n_lists))[:-1])
+
+    # Returns the positions of up to k profiled candidates with the highest scores against the query, best first
+    def search(self, query: np.ndarray, k: int) -> List[int]:
+        if self.centroids is None:
+            positions = self.profiled
+        else:
+            probed = top_positions(np.matmul(self.centroids, query), self.probes)
+            positions = np.concatenate([ self.lists[c] for c in probed.tolist() ])
+        if len(positions) == 0:
+            return []
+        best_positions: List[np.ndarray] = []
+        best_scores: List[np.ndarray] = []
+        for start in range(0, len(positions), BLOCK_SIZE):
+            block = positions[start:start + BLOCK_SIZE]
+            scores = np.matmul(self.profiles.gather(self.rows[block]), query)
+            best = top_positions(scores, k)
+            best_positions.append(block[best])
+            best_scores.append(scores[best])
+        scores = np.concatenate(best_scores)
+        return cast(List[int], np.concatenate(best_positions)[top_positions(scores, k)].tolist())
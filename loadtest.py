@@ -0,0 +1,148 @@
+from typing import List, Dict, Any, Optional
+import argparse
+import http.client
+import json
+import random
+import socket
+import threading
+import time
+from http.cookies import SimpleCookie
+
+# Simulates many browsers that have the feed page open.
+# Each simulated client loads feed.html (to obtain a session cookie),
+# then polls feed_ajax.html with 'update' requests (or long-polls with 'wait' requests), just like feed.html does.
+# Usage (with the server already running):
+#   python3 loadtest.py --clients 300 --seconds 30
+
+class Client(threading.Thread):
+    def __init__(self, host: str, port: int, post: str, interval: float, stop_time: float, long_poll: bool) -> None:
+        threading.Thread.__init__(self, daemon=True)
+        self.host = host
+        self.port = port
+        self.post = post
+        self.interval = interval
+        self.long_poll = long_poll
+        self.stop_time = stop_time
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.session_id = ''
+        self.rev = 0
+        self.op_list: List[str] = []
+        self.op_revs: List[int] = []
+        self.notif_count = 0
+
+    def request(self, method: str, path: str, body: Optional[bytes]) -> bytes:
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            headers: Dict[str, str] = { 'Content-Type': 'application/x-www-form-urlencoded' }
+            if len(self.session_id) > 0:
+                headers['Cookie'] = f'sid={self.session_id}'
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            content = response.read()
+            if response.status != 200:
+                raise ValueError(f'Server returned status {response.status}')
+            cookie = SimpleCookie(response.getheader('Set-Cookie') or '')
+            if 'sid' in cookie:
+                self.session_id = cookie['sid'].value
+            return content
+        finally:
+            conn.close()
+
+    def poll(self) -> None:
+        payload: Dict[str, Any] = {
+            'act': 'wait' if self.long_poll else 'update',
+            'nc': self.notif_count,
+            'post': self.post,
+            'rev': self.rev,
+            'ops': self.op_list,
+            'opr': self.op_revs,
+        }
+        response = json.loads(self.request('POST', '/feed_ajax.html', bytes(json.dumps(payload), 'utf8')))
+        self.rev = response['rev']
+        self.op_list = response['ops']
+        self.op_revs = response['opr']
+        for up in response['updates']:
+            if up['act'] == 'nc':
+                self.notif_count = up['val']
+
+    def run(self) -> None:
+        try:
+            self.request('GET', f'/feed.html?post={self.post}', None)
+        except Exception:
+            self.errors += 1
+            return
+        time.sleep(random.uniform(0., self.interval)) # Spread the clients out like real browsers
+        while time.time() < self.stop_time:
+            start = time.time()
+            try:
+                self.poll()
+                self.latencies.append(time.time() - start)
+            except Exception:
+                self.errors += 1
+                time.sleep(self.interval)
+            if not self.long_poll:
+                time.sleep(max(0., self.interval - (time.time() - start)))
+
+# Simulates a client on a slow connection (such as a phone uploading an image).
+# It sends a request header, then trickles the body one byte at a time until the test ends.
+class SlowClient(threading.Thread):
+    def __init__(self, host: str, port: int, stop_time: float) -> None:
+        threading.Thread.__init__(self, daemon=True)
+        self.host = host
+        self.port = port
+        self.stop_time = stop_time
+
+    def run(self) -> None:
+        sock = socket.create_connection((self.host, self.port))
+        try:
+            sock.sendall(b'POST /feed_ajax.html HTTP/1.1\r\nCookie: sid=slowclient00\r\nContent-Type: application/x-www-form-urlencoded\r\nContent-Length: 1000000\r\n\r\n')
+            while time.time() < self.stop_time:
+                sock.sendall(b' ')
+                time.sleep(0.5)
+        except Exception:
+            pass
+        finally:
+            sock.close()
+
+def percentile(sorted_vals: List[float], p: float) -> float:
+    if len(sorted_vals) == 0:
+        return 0.
+    return sorted_vals[min(len(sorted_vals) - 1, int(p * len(sorted_vals)))]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Simulates many polling clients and reports throughput and latency')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8986)
+    parser.add_argument('--clients', type=int, default=300, help='number of simulated browsers')
+    parser.add_argument('--seconds', type=float, default=30., help='duration of the test')
+    parser.add_argument('--interval', type=float, default=5., help='seconds between polls for each client')
+    parser.add_argument('--post', default='000000000000', help='the post each client views')
+    parser.add_argument('--long-poll', action='store_true', help='use long-poll \'wait\' requests instead of polling')
+    parser.add_argument('--slow', type=int, default=0, help='number of clients that trickle a request body slowly')
+    args = parser.parse_args()
+
+    stop_time = time.time() + args.seconds
+    slow_clients = [ SlowClient(args.host, args.port, stop_time) for _ in range(args.slow) ]
+    for sc in slow_clients:
+        sc.start()
+    clients = [ Client(args.host, args.port, args.post, args.interval, stop_time, args.long_poll) for _ in range(args.clients) ]
+    start = time.time()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.time() - start
+
+    latencies = sorted([ lat for c in clients for lat in c.latencies ])
+    errors = sum([ c.errors for c in clients ])
+    print(f'clients:       {args.clients} (+{args.slow} slow)')
+    print(f'requests:      {len(latencies)} ({errors} errors)')
+    print(f'requests/sec:  {len(latencies) / elapsed:.1f}')
+    print(f'p50 latency:   {percentile(latencies, 0.50) * 1000.:.1f} ms')
+    print(f'p90 latency:   {percentile(latencies, 0.90) * 1000.:.1f} ms')
+    print(f'p99 latency:   {percentile(latencies, 0.99) * 1000.:.1f} ms')
+    print(f'max latency:   {(latencies[-1] if len(latencies) > 0 else 0.) * 1000.:.1f} ms')
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ from db import db
 import sys
 import os
 import posts
+import cache
 from config import config
 
 def do_index(query: Mapping[str, Any], session: sessions.Session) -> str:
@@ -52,10 +53,21 @@ def bootstrap() -> None:
         posts.new_post(root_id, '', 'cat', 'Everything', '')
     sessions.session_cache.set_modified(session.id)
 
+# Retrains the recommender offline (python3 main.py <folder> train ...), then saves and exits
+def train(args: List[str]) -> None:
+    import bulk_train
+    bulk_train.run(args)
+    db.save()
+
 if __name__ == "__main__":
     db.load()
+    if len(sys.argv) > 2 and sys.argv[2] == 'train':
+        train(sys.argv[3:])
+        sys.exit(0)
     if db.have_no_accounts():
         bootstrap()
+    cache.start_flusher()
+    rec.start_trainer()
     webserver.SimpleWebServer.render({
         'index.html': do_index,
         'feed.html': feed.do_feed,
@@ -64,5 +76,8 @@ if __name__ == "__main__":
         'account_ajax.html': accounts.do_ajax,
         'receive_image.html': accounts.receive_image,
     })
+    rec.stop_trainer()
+    cache.stop_flusher()
+    cache.print_stats()
     db.save()
     print('\nGoodbye.')
@@ -24,7 +24,7 @@ def fetch_notif_in(id: str) -> NotifIn:
 def store_notif_in(id: str, notif_in: NotifIn) -> None:
     db.put_notif_in(id, notif_in.marshal())
 
-notif_in_cache: cache.Cache[str,NotifIn] = cache.Cache(100, fetch_notif_in, store_notif_in)
+notif_in_cache: cache.Cache[str,NotifIn] = cache.Cache(100, fetch_notif_in, store_notif_in, 'notif_in')
 
 def get_or_make_notif_in(account_id: str) -> NotifIn:
     try:
@@ -63,7 +63,7 @@ def fetch_notif_out(id: str) -> NotifOut:
 def store_notif_out(id: str, notif_out: NotifOut) -> None:
     db.put_notif_out(id, notif_out.marshal())
 
-notif_out_cache: cache.Cache[str,NotifOut] = cache.Cache(100, fetch_notif_out, store_notif_out)
+notif_out_cache: cache.Cache[str,NotifOut] = cache.Cache(100, fetch_notif_out, store_notif_out, 'notif_out')
 
 
 
@@ -77,6 +77,7 @@ def notify(dest_account_id: str, type: str, post_id: str, src_account_id: str) -
         notif_in = notif_in_cache.add(dest_account_id, NotifIn())
     assert len(notif_in.notifs) < 1000, 'Notifications are out of control!'
     notif_in.notifs.append((type, post_id, src_account_id))
+    cache.notify_changed()
 
 # Extract a group of notifications that all have the same type and node id
 def group_notifs(notif_in: List[Tuple[str, str, str]]) -> List[Tuple[str, str, str]]:
@@ -125,4 +126,5 @@ def digest_notifications(account_id: str) -> List[Tuple[str, str, str, str]]:
     if dirty:
         notif_in_cache.set_modified(account_id)
         notif_out_cache.set_modified(account_id)
+        cache.notify_changed()
     return notif_out.notifs
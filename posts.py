@@ -7,6 +7,14 @@ import history
 import accounts
 import cache
 
+# Incremented when something that many cached encodings depend on changes (an author's name or picture, or a whitelist),
+# so every post encodes itself again the next time it is sent
+encoding_generation = 0
+
+def invalidate_encodings() -> None:
+    global encoding_generation
+    encoding_generation += 1
+
 def new_post_id() -> str:
     return ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for _ in range(12))
 
@@ -23,6 +31,9 @@ class Post():
         self.emos: List[Tuple[int, str]] = []
         self.ratings: Optional[List[int]] = None
         self.rating_count = 0
+        self.aioff_score: Optional[Tuple[int, float]] = None # Caches the index of the strongest aioff rating and the aioff score. (Not saved.)
+        self.encoded: Optional[Dict[str, Any]] = None # Caches the part of encode_for_client that is the same for every reader. (Not saved.)
+        self.encoded_generation = 0
 
     def marshal(self) -> Mapping[str, Any]:
         return {
@@ -54,6 +65,7 @@ class Post():
             assert ratings[i] >= 0. and ratings[i] <= 1., 'rating out of range'
             self.ratings[i] -= max(0, min(1, int(ratings[i])))
         self.rating_count -= 1
+        self.aioff_score = None
 
     def add_rating(self, ratings: List[float]) -> None:
         if self.ratings is None:
@@ -62,8 +74,38 @@ class Post():
             assert ratings[i] >= 0. and ratings[i] <= 1., 'rating out of range'
             self.ratings[i] += max(0, min(1, int(ratings[i])))
         self.rating_count += 1
+        self.aioff_score = None
+
+    def add_emo(self, emo: int, name: str) -> None:
+        self.emos.append((emo, name))
+        self.encoded = None
 
+    # Returns the packet that tells a client about this post.
+    # The part that is the same for every reader is cached, and each reader gets a copy with its own fields added.
     def encode_for_client(self, account_id:str, depth:int, add_new_op:bool=False) -> Dict[str, Any]:
+        if self.encoded is None or self.encoded_generation != encoding_generation:
+            self.encoded = self.encode_shared()
+            self.encoded_generation = encoding_generation
+        outgoing_packet = dict(self.encoded)
+        outgoing_packet['dep'] = depth
+
+        # Allow adding a new OP
+        if add_new_op:
+            outgoing_packet['nop'] = True
+
+        # Tell the client whether this reader may post in a debate
+        if len(self.parent_id) > 0 and self.type == 'pod' and len(self.wl) > 0:
+            if account_id in self.wl: # if the reader is in the whitelist...
+                pass
+            elif len(self.wl) == 1:
+                outgoing_packet['ro'] = 1 # Allow accepting the debate challenge
+            else:
+                outgoing_packet['ro'] = 2 # The user may read only
+
+        return outgoing_packet
+
+    # Encodes the fields of the client packet that do not depend on who is reading
+    def encode_shared(self) -> Dict[str, Any]:
         # Give the post content to the client
         outgoing_packet: Dict[str, Any] = {
             'act': 'add',
@@ -71,14 +113,9 @@ class Post():
             'par': self.parent_id,
             'type': self.type,
             'text': self.text,
-            'dep': depth,
             'emos': self.emos[-8:],
         }
 
-        # Allow adding a new OP
-        if add_new_op:
-            outgoing_packet['nop'] = True
-
         # Give the client the author's picture and name
         if len(self.account_id) > 0:
             acc = accounts.account_cache[self.account_id]
@@ -86,18 +123,11 @@ class Post():
             outgoing_packet['name'] = acc.name
             outgoing_packet['aid'] = acc.id
 
-        # Tell the client about any relevant whitelist
-        if len(self.parent_id) > 0:
+        # Tell the client how to indent posts in a debate
+        if len(self.parent_id) > 0 and not (self.type == 'pod' and len(self.wl) > 0):
             par = post_cache[self.parent_id]
-            if self.type == 'pod' and len(self.wl) > 0:
-                if account_id in self.wl: # if the reader is in the whitelist...
-                    pass
-                elif len(self.wl) == 1:
-                    outgoing_packet['ro'] = 1 # Allow accepting the debate challenge
-                else:
-                    outgoing_packet['ro'] = 2 # The user may read only
-            elif par.type == 'pod' and len(par.wl) > 0:
-                outgoing_packet['ind'] = par.wl.index(self.account_id) # Tell the client how to indent the post
+            if par.type == 'pod' and len(par.wl) > 0:
+                outgoing_packet['ind'] = par.wl.index(self.account_id)
 
         return outgoing_packet
 
@@ -117,7 +147,14 @@ def store_post(id: str, post: Post) -> None:
     assert id == post.id, 'mismatching ids'
     db.put_post(id, post.marshal())
 
-post_cache: cache.Cache[str,Post] = cache.Cache(1000, fetch_post, store_post)
+def fetch_posts(ids: List[str]) -> Mapping[str, Post]:
+    docs = db.get_posts(ids)
+    return { id: Post.unmarshal(id, docs[id]) for id in docs }
+
+def store_posts(items: List[Tuple[str, Post]]) -> None:
+    db.put_posts([ (id, post.marshal()) for id, post in items ])
+
+post_cache: cache.Cache[str,Post] = cache.Cache(1000, fetch_post, store_post, 'posts', 'tinylfu', get_many_func=fetch_posts, put_many_func=store_posts)
 
 # Makes a new post and inserts it into the tree
 def new_post(id: str, parent_id: str, type: str, text: str, account_id: str) -> Post:
@@ -140,6 +177,12 @@ def new_post(id: str, parent_id: str, type: str, text: str, account_id: str) ->
         history.history_cache.set_modified(op_id)
     return post_cache.add(id, Post(id, parent_id, op_id, type, text, account_id))
 
+# Loads the parents and authors of the specified posts into the caches with one database call each,
+# so that encode_for_client will not need to hit the database for them one at a time
+def prefetch_for_client(post_list: List[Post]) -> None:
+    post_cache.get_many([ post.parent_id for post in post_list if len(post.parent_id) > 0 ])
+    accounts.account_cache.get_many([ post.account_id for post in post_list if len(post.account_id) > 0 ])
+
 def summarize_post(post_id: str, n: int) -> str:
     post = post_cache[post_id]
     summary = post.text[:n] + ('...' if len(post.text) > n else '')
@@ -0,0 +1,187 @@
+from typing import Callable, Dict, List, Mapping, Tuple, Any, Optional, BinaryIO, cast
+import os
+import time
+import numpy as np
+import cache
+from config import config
+
+# Holds every user or item profile in one contiguous float32 matrix, with an index from ids to rows.
+# Nothing is ever evicted, so a profile costs its row (4 bytes per value) plus its index entry,
+# and batches of profiles can be gathered or scattered with fancy indexing.
+# Profiles that are not in the table yet are looked up with get_many_func (which should omit ids it does not have).
+# If filename is empty, rows flagged as modified are written back with put_many_func (by the write-behind flusher, like a cache).
+# Otherwise, the matrix is memory-mapped from filename + '.f32' and the ids are appended to filename + '.ids',
+# so the table is its own storage and put_many_func is never called.
+class ProfileTable():
+    def __init__(self,
+        width: int,
+        name: str,
+        get_many_func: Callable[[List[str]], Mapping[str, np.ndarray]],
+        put_many_func: Callable[[List[Tuple[str, np.ndarray]]], None],
+        filename: str = '',
+    ) -> None:
+        self.width = width
+        self.name = name
+        self.get_many_func = get_many_func
+        self.put_many_func = put_many_func
+        self.filename = filename
+        self.ids: List[str] = [] # Maps rows to ids
+        self.rows: Dict[str, int] = {} # Maps ids to rows
+        self.size = 0
+        self.matrix = np.zeros([0, width], dtype=np.float32)
+        self.ids_file: Optional[BinaryIO] = None
+        self.modified: Dict[int, float] = {} # Maps each modified row to the time it was first modified
+        self.max_modified = cast(int, config['write_behind_max_dirty'])
+        self.hits = 0
+        self.misses = 0
+        self.write_backs = 0
+        if len(filename) > 0:
+            self.open()
+        cache.all_caches.append(self)
+
+    def __len__(self) -> int:
+        return self.size
+
+    # Maps the files for this table, creating them if necessary
+    def open(self) -> None:
+        folder = os.path.dirname(self.filename)
+        if len(folder) > 0:
+            os.makedirs(folder, exist_ok=True)
+        ids: List[str] = []
+        if os.path.exists(self.filename + '.ids'):
+            with open(self.filename + '.ids', mode='rb') as infile:
+                ids = str(infile.read(), 'utf8').split('\n')[:-1] # (An id that was only partly written has no newline, so it is dropped)
+        if not os.path.exists(self.filename + '.f32'):
+            with open(self.filename + '.f32', mode='wb'):
+                pass
+        capacity = os.path.getsize(self.filename + '.f32') // (4 * self.width)
+        self.ids = ids[:capacity]
+        self.rows = { id: row for row, id in enumerate(self.ids) }
+        self.size = len(self.ids)
+        self.map(max(capacity, 1024))
+        self.ids_file = open(self.filename + '.ids', mode='ab', buffering=0)
+        self.ids_file.truncate(sum([ len(bytes(id, 'utf8')) + 1 for id in self.ids ]))
+
+    # Maps the matrix file with room for the specified number of rows, growing the file if necessary
+    def map(self, capacity: int) -> None:
+        if isinstance(self.matrix, np.memmap):
+            self.matrix.flush()
+        with open(self.filename + '.f32', mode='r+b') as file:
+            if os.path.getsize(self.filename + '.f32') < capacity * 4 * self.width:
+                file.truncate(capacity * 4 * self.width)
+        self.matrix = np.memmap(self.filename + '.f32', dtype='<f4', mode='r+', shape=(capacity, self.width))
+
+    # Makes room for at least the specified number of rows
+    def reserve(self, capacity: int) -> None:
+        if capacity > self.matrix.shape[0]:
+            capacity = max(capacity, 2 * self.matrix.shape[0], 1024)
+            if len(self.filename) > 0:
+                self.map(capacity)
+            else:
+                self.matrix = np.resize(self.matrix, [capacity, self.width])
+
+    # Flags rows to be written back to the database (unless the table is memory-mapped)
+    def set_modified(self, rows: List[int]) -> None:
+        if self.ids_file is not None:
+            return
+        now = time.monotonic()
+        for row in rows:
+            if not row in self.modified:
+                self.modified[row] = now
+        if len(self.modified) > self.max_modified:
+            # Apply backpressure, like cache.Cache does
+            self.write_back(len(self.modified) - self.max_modified // 2, now)
+
+    # Puts a profile for a new id in the next row. Returns that row.
+    def append(self, id: str, vals: np.ndarray) -> int:
+        self.reserve(self.size + 1)
+        row = self.size
+        self.matrix[row] = vals
+        self.rows[id] = row
+        self.ids.append(id)
+        self.size += 1
+        if self.ids_file is not None:
+            self.ids_file.write(bytes(id + '\n', 'utf8')) # (The row is written first, so a crash never leaves an id without its row)
+        return row
+
+    # Adds or replaces the profile for an id. Returns its row.
+    def add(self, id: str, vals: np.ndarray) -> int:
+        row = self.rows.get(id, -1)
+        if row < 0:
+            row = self.append(id, vals)
+        else:
+            self.matrix[row] = vals
+        self.set_modified([ row ])
+        return row
+
+    # Returns the row for each id, or -1 for ids that have no profile.
+    # Fetches all the ids that are not in the table with a single database call.
+    def find_many(self, ids: List[str]) -> np.ndarray:
+        rows = np.array([ self.rows.get(id, -1) for id in ids ], dtype=np.int64)
+        missing = list(dict.fromkeys([ id for id, row in zip(ids, rows.tolist()) if row < 0 ]))
+        self.hits += len(ids) - len(missing)
+        if len(missing) == 0:
+            return rows
+        self.misses += len(missing)
+        fetched = self.get_many_func(missing)
+        if len(fetched) == 0:
+            return rows
+        self.reserve(self.size + len(fetched))
+        for id, vals in fetched.items():
+            self.append(id, vals)
+        return np.array([ self.rows.get(id, -1) for id in ids ], dtype=np.int64)
+
+    # Returns the row for an id, or -1 if it has no profile
+    def find(self, id: str) -> int:
+        row = self.rows.get(id, -1)
+        if row >= 0:
+            self.hits += 1
+            return row
+        return cast(int, self.find_many([ id ])[0])
+
+    # Returns a (len(rows), width) matrix of the profiles in the specified rows
+    def gather(self, rows: np.ndarray) -> np.ndarray:
+        return cast(np.ndarray, self.matrix[rows])
+
+    # Replaces the profiles in the specified rows
+    def scatter(self, rows: np.ndarray, vals: np.ndarray) -> None:
+        self.matrix[rows] = vals
+        self.set_modified(rows.tolist())
+
+    # Writes up to max_count modified profiles (that were first modified before the specified time) to the database.
+    # Returns the number of profiles that were written.
+    def write_back(self, max_count: int, modified_before: float) -> int:
+        written: List[int] = []
+        for row, t in self.modified.items(): # (in the order they were modified)
+            if len(written) >= max_count or t >= modified_before:
+                break
+            written.append(row)
+        if len(written) == 0:
+            return 0
+        self.put_many_func([ (self.ids[row], vals) for row, vals in zip(written, self.matrix[written]) ])
+        for row in written:
+            del self.modified[row]
+        self.write_backs += len(written)
+        return len(written)
+
+    # Writes all the modified profiles to storage.
+    # (Unlike cache.Cache.flush, this keeps every profile in memory.)
+    def flush(self) -> None:
+        self.write_back(len(self.modified), float('inf'))
+        if isinstance(self.matrix, np.memmap):
+            self.matrix.flush()
+
+    # Returns counters in the same form as cache.Cache.stats
+    def stats(self) -> Mapping[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'name': self.name,
+            'policy': 'memmap' if self.ids_file is not None else 'none',
+            'size': self.size,
+            'max_size': self.matrix.shape[0],
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': 0,
+            'write_backs': self.write_backs,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.,
+        }
@@ -0,0 +1,160 @@
+from typing import Dict, List, Tuple, Mapping, Iterable, BinaryIO, cast
+import numpy as np
+
+# Splits a 'user,item' key into its two ids
+def split_key(key: str) -> Tuple[str, str]:
+    first_comma = key.index(',')
+    return key[:first_comma], key[first_comma+1:]
+
+# A compact table of ratings, stored in columns.
+# User and item ids are interned as small integers, and all the rating values live in one float32 matrix,
+# so each rating costs a few dozen bytes instead of a string key, a list, and a float object per value.
+class RatingsTable():
+    def __init__(self) -> None:
+        self.user_ids: List[str] = [] # Maps user numbers to user ids
+        self.item_ids: List[str] = [] # Maps item numbers to item ids
+        self.user_nums: Dict[str, int] = {} # Maps user ids to user numbers
+        self.item_nums: Dict[str, int] = {} # Maps item ids to item numbers
+        self.user_rows: List[Dict[str, int]] = [] # For each user number, maps the ids of the items that user rated to rows
+        self.size = 0
+        self.users = np.zeros([0], dtype=np.int32) # The user number for each row
+        self.items = np.zeros([0], dtype=np.int32) # The item number for each row
+        self.vals = np.zeros([0, 0], dtype=np.float32) # The ratings for each row
+
+    def __len__(self) -> int:
+        return self.size
+
+    # Returns the row for a user-item pair, or -1 if that pair has not been rated
+    def find(self, user: str, item: str) -> int:
+        u = self.user_nums.get(user, -1)
+        if u < 0:
+            return -1
+        return self.user_rows[u].get(item, -1)
+
+    # Returns the ratings this user has made for any of the specified items, keyed by item id
+    def get_for_user(self, user: str, items: Iterable[str]) -> Dict[str, List[float]]:
+        u = self.user_nums.get(user, -1)
+        if u < 0:
+            return {}
+        rows = self.user_rows[u]
+        rated = list(rows.keys() & items)
+        if len(rated) == 0:
+            return {}
+        return dict(zip(rated, self.vals[[ rows[item] for item in rated ]].tolist()))
+
+    # Returns the number for an id, assigning a new one if necessary
+    @staticmethod
+    def intern(id: str, ids: List[str], nums: Dict[str, int]) -> int:
+        num = nums.get(id, -1)
+        if num < 0:
+            num = len(ids)
+            nums[id] = num
+            ids.append(id)
+        return num
+
+    # Makes room for at least the specified number of rows
+    def reserve(self, capacity: int, width: int) -> None:
+        if self.vals.shape[1] != width:
+            if self.size > 0:
+                raise ValueError(f'Expected {self.vals.shape[1]} rating values, got {width}')
+            self.vals = np.zeros([self.vals.shape[0], width], dtype=np.float32)
+        if capacity > self.users.shape[0]:
+            capacity = max(capacity, 2 * self.users.shape[0], 1024)
+            self.users = np.resize(self.users, capacity)
+            self.items = np.resize(self.items, capacity)
+            self.vals = np.resize(self.vals, [capacity, width])
+
+    # Adds or replaces the ratings for a user-item pair
+    def put(self, user: str, item: str, vals: List[float]) -> None:
+        u = RatingsTable.intern(user, self.user_ids, self.user_nums)
+        if u == len(self.user_rows):
+            self.user_rows.append({})
+        i = RatingsTable.intern(item, self.item_ids, self.item_nums)
+        rows = self.user_rows[u]
+        row = rows.get(item, -1)
+        if row < 0:
+            self.reserve(self.size + 1, len(vals))
+            row = self.size
+            rows[self.item_ids[i]] = row # (uses the interned copy of the id string)
+            self.users[row] = u
+            self.items[row] = i
+            self.size += 1
+        elif len(vals) != self.vals.shape[1]:
+            raise ValueError(f'Expected {self.vals.shape[1]} rating values, got {len(vals)}')
+        self.vals[row] = vals
+
+    # Returns the ratings for a user-item pair. Raises KeyError if that pair has not been rated.
+    def get(self, user: str, item: str) -> List[float]:
+        row = self.find(user, item)
+        if row < 0:
+            raise KeyError(f'{user},{item}')
+        return cast(List[float], self.vals[row].tolist())
+
+    # Returns n randomly chosen rows (with replacement) as (user numbers, item numbers, ratings) arrays
+    def sample_arrays(self, n: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        assert self.size > 0, 'No ratings to choose from'
+        rows = np.random.randint(0, self.size, size=n)
+        return self.users[rows], self.items[rows], self.vals[rows]
+
+    # Returns n randomly chosen (user id, item id, ratings) tuples (with replacement)
+    def sample(self, n: int) -> List[Tuple[str, str, List[float]]]:
+        users, items, vals = self.sample_arrays(n)
+        return [ (self.user_ids[u], self.item_ids[i], v) for u, i, v in zip(users.tolist(), items.tolist(), vals.tolist()) ]
+
+    # Returns the rows from start up to stop as (user ids, item ids, ratings matrix)
+    def columns(self, start: int, stop: int) -> Tuple[List[str], List[str], np.ndarray]:
+        users = [ self.user_ids[u] for u in self.users[start:stop].tolist() ]
+        items = [ self.item_ids[i] for i in self.items[start:stop].tolist() ]
+        return users, items, self.vals[start:stop].copy()
+
+    # Returns all the ratings as a mapping from 'user,item' keys to lists of values
+    def to_mapping(self) -> Mapping[str, List[float]]:
+        vals = self.vals[:self.size].tolist()
+        return { f'{self.user_ids[u]},{self.item_ids[i]}': vals[row] for row, (u, i) in enumerate(zip(self.users[:self.size].tolist(), self.items[:self.size].tolist())) }
+
+    # Consumes a mapping from 'user,item' keys to lists of values
+    @staticmethod
+    def from_mapping(m: Mapping[str, List[float]]) -> "RatingsTable":
+        table = RatingsTable()
+        table.reserve(len(m), len(next(iter(m.values()))) if len(m) > 0 else 0)
+        for key, vals in m.items():
+            user, item = split_key(key)
+            table.put(user, item, vals)
+        return table
+
+    # Returns the table as a list of blobs for writing to a file.
+    # The format is a header line, the user ids and item ids separated by newlines,
+    # then the user column, the item column, and the ratings matrix, all little-endian.
+    def to_blobs(self) -> List[bytes]:
+        users = bytes('\n'.join(self.user_ids), 'utf8')
+        items = bytes('\n'.join(self.item_ids), 'utf8')
+        header = f'ratings 2 {self.size} {self.vals.shape[1]} {len(self.user_ids)} {len(self.item_ids)} {len(users)} {len(items)}\n'
+        return [
+            bytes(header, 'utf8'),
+            users,
+            items,
+            self.users[:self.size].astype('<i4').tobytes(),
+            self.items[:self.size].astype('<i4').tobytes(),
+            self.vals[:self.size].astype('<f4').tobytes(),
+        ]
+
+    # Reads a table in the format written by to_blobs
+    @staticmethod
+    def from_file(file: BinaryIO) -> "RatingsTable":
+        header = file.readline().split()
+        assert header[0] == b'ratings', 'unrecognized ratings file'
+        assert header[1] == b'2', 'unsupported ratings file version'
+        n, k, n_users, n_items, users_len, items_len = [ int(x) for x in header[2:] ]
+        table = RatingsTable()
+        table.user_ids = str(file.read(users_len), 'utf8').split('\n') if n_users > 0 else []
+        table.item_ids = str(file.read(items_len), 'utf8').split('\n') if n_items > 0 else []
+        table.user_nums = { id: num for num, id in enumerate(table.user_ids) }
+        table.item_nums = { id: num for num, id in enumerate(table.item_ids) }
+        table.users = np.fromfile(file, dtype='<i4', count=n).astype(np.int32)
+        table.items = np.fromfile(file, dtype='<i4', count=n).astype(np.int32)
+        table.vals = np.fromfile(file, dtype='<f4', count=n * k).astype(np.float32).reshape([n, k])
+        table.size = n
+        table.user_rows = [ {} for _ in table.user_ids ]
+        for row, (u, i) in enumerate(zip(table.users.tolist(), table.items.tolist())):
+            table.user_rows[u][table.item_ids[i]] = row
+        return table
@@ -1,14 +1,20 @@
-from typing import Tuple, Mapping, Any, Optional, List, Dict, Set
+from typing import Tuple, Mapping, Any, Optional, List, Dict, Set, cast
 import numpy as np
-import tensorflow as tf
-import nn
 import random
+import queue
+import threading
+import traceback
 import heapq
+import os
+import time
 from datetime import datetime
 import dateutil.parser # (When Python 3.7 becomes available, omit this line and use datetime.fromisoformat where needed)
 from indexable_dict import IndexableDict
 from db import db
 import cache
+from profile_table import ProfileTable
+from item_index import ItemIndex, top_positions
+from config import config
 
 rating_choices = [
     (1.,'Strong','Support for a position was given that would be difficult to dismiss'),
@@ -31,68 +37,153 @@ rating_choices = [
     (-1.,'Unclear relevance','Miscategorized, off-topic, incoherent, word salad, or spam'),
 ]
 
+# The sign of each choice, for weighting ratings into an overall score
+rating_signs = np.array([ choice[0] for choice in rating_choices ])
+
 rating_freq = [ 5 for _ in rating_choices ]
 rating_count = 5 * len(rating_choices)
 
 
 PROFILE_SIZE = 12
 
+LEARNING_RATE = 1e-5
+
+# The interface for the pair model, which predicts the ratings for a batch of user-item pairs
+# from the element-wise product of their profiles
 class Model:
-    def __init__(self) -> None:
-        self.batch_size = 64
-        self.batch_user = tf.Variable(np.zeros([self.batch_size, PROFILE_SIZE]), dtype = tf.float32)
-        self.batch_item = tf.Variable(np.zeros([self.batch_size, PROFILE_SIZE]), dtype = tf.float32)
-        self.common_layer = nn.LayerLinear(PROFILE_SIZE, len(rating_choices))
-        self.optimizer = tf.keras.optimizers.SGD(learning_rate = 1e-5)
-        self.params = self.common_layer.params
+    batch_size: int
+
+    # Consumes a (batch_size, PROFILE_SIZE) matrix of user profiles
+    def set_users(self, user_profiles: np.ndarray) -> None:
+        raise NotImplementedError('Expected an override')
+
+    # Consumes a (batch_size, PROFILE_SIZE) matrix of item profiles
+    def set_items(self, item_profiles: np.ndarray) -> None:
+        raise NotImplementedError('Expected an override')
+
+    def get_users(self) -> np.ndarray:
+        raise NotImplementedError('Expected an override')
 
-    def set_users(self, user_profiles: tf.Tensor) -> None:
-        self.batch_user.assign(user_profiles)
+    def get_items(self) -> np.ndarray:
+        raise NotImplementedError('Expected an override')
 
-    def set_items(self, item_profiles: tf.Tensor) -> None:
-        self.batch_item.assign(item_profiles)
+    # Returns a (batch_size, len(rating_choices)) matrix of predicted ratings
+    def predict(self) -> np.ndarray:
+        raise NotImplementedError('Expected an override')
 
-    def act(self) -> tf.Tensor:
-        common = self.common_layer.act(self.batch_user * self.batch_item)
-        return common
+    # Consumes (n, PROFILE_SIZE) matrices of user and item profiles for any n
+    # Returns an (n, len(rating_choices)) matrix of predicted ratings
+    def predict_many(self, users: np.ndarray, items: np.ndarray) -> np.ndarray:
+        raise NotImplementedError('Expected an override')
 
-    def cost(self, targ: tf.Tensor, pred: tf.Tensor) -> tf.Tensor:
-        return tf.reduce_mean(tf.reduce_sum(tf.square(targ - pred), axis = 1), axis = 0)
+    # Takes one step of gradient descent toward the specified ratings
+    def refine(self, y: np.ndarray) -> None:
+        raise NotImplementedError('Expected an override')
 
-    def refine(self, y: tf.Tensor) -> None:
-        self.optimizer.minimize(lambda: self.cost(y, self.act()), self.params)
+    # Returns the weights (PROFILE_SIZE, len(rating_choices)) and bias (len(rating_choices)) of the layer
+    # that maps the product of a user profile and an item profile to ratings
+    def get_common_layer(self) -> Tuple[np.ndarray, np.ndarray]:
+        raise NotImplementedError('Expected an override')
 
     def marshal(self) -> Mapping[str, Any]:
-        return {
-                "params": [ p.numpy().tolist() for p in self.params ],
-            }
+        raise NotImplementedError('Expected an override')
 
     def unmarshal(self, ob: Mapping[str, Any]) -> None:
-        params = ob['params']
-        if len(params) != len(self.params):
-            raise ValueError('Mismatching number of params')
-        for i in range(len(params)):
-            self.params[i].assign(np.array(params[i]))
+        raise NotImplementedError('Expected an override')
+
+# The pair model implemented with NumPy.
+# Its params have the same shapes as the TensorFlow model's, so either one can load what the other saved.
+class NumPyModel(Model):
+    def __init__(self, profile_size: int, rating_size: int, batch_size: int = 64, learning_rate: float = LEARNING_RATE) -> None:
+        self.batch_size = batch_size
+        self.learning_rate = learning_rate
+        self.batch_user = np.zeros([self.batch_size, profile_size], dtype=np.float32)
+        self.batch_item = np.zeros([self.batch_size, profile_size], dtype=np.float32)
+        stddev = max(0.03, 1.0 / profile_size)
+        self.weights = np.random.normal(0., stddev, [profile_size, rating_size]).astype(np.float32)
+        self.bias = np.random.normal(0., stddev, [rating_size]).astype(np.float32)
 
+    def set_users(self, user_profiles: np.ndarray) -> None:
+        self.batch_user[:] = user_profiles
 
-def fetch_user_profile(id: str) -> np.ndarray:
-    return np.array(db.get_user_profile(id)['vals'])
+    def set_items(self, item_profiles: np.ndarray) -> None:
+        self.batch_item[:] = item_profiles
 
-def store_user_profile(id: str, vals: np.ndarray) -> None:
-    db.put_user_profile(id, {'vals': vals.tolist()})
+    def get_users(self) -> np.ndarray:
+        return self.batch_user.copy()
 
-def fetch_item_profile(id: str) -> np.ndarray:
-    return np.array(db.get_item_profile(id)['vals'])
+    def get_items(self) -> np.ndarray:
+        return self.batch_item.copy()
 
-def store_item_profile(id: str, vals: np.ndarray) -> None:
-    db.put_item_profile(id, {'vals': vals.tolist()})
+    def predict(self) -> np.ndarray:
+        return cast(np.ndarray, np.matmul(self.batch_user * self.batch_item, self.weights) + self.bias)
 
+    def predict_many(self, users: np.ndarray, items: np.ndarray) -> np.ndarray:
+        return cast(np.ndarray, np.matmul((users * items).astype(np.float32), self.weights) + self.bias)
 
+    # The cost is mean(sum((y - pred)^2)), so its gradient with respect to pred is 2 * (pred - y) / batch_size.
+    # (Like the TensorFlow model, this only refines the weights and bias, not the profiles.)
+    def refine(self, y: np.ndarray) -> None:
+        x = self.batch_user * self.batch_item
+        blame = (np.matmul(x, self.weights) + self.bias - y) * (2. / x.shape[0])
+        self.weights -= self.learning_rate * np.matmul(x.T, blame)
+        self.bias -= self.learning_rate * np.sum(blame, axis=0)
+
+    def get_common_layer(self) -> Tuple[np.ndarray, np.ndarray]:
+        return self.weights, self.bias
+
+    def marshal(self) -> Mapping[str, Any]:
+        return {
+                "params": [ self.weights.tolist(), self.bias.tolist() ],
+            }
+
+    def unmarshal(self, ob: Mapping[str, Any]) -> None:
+        params = ob['params']
+        if len(params) != 2:
+            raise ValueError('Mismatching number of params')
+        weights = np.array(params[0], dtype=np.float32)
+        bias = np.array(params[1], dtype=np.float32)
+        if weights.shape != self.weights.shape or bias.shape != self.bias.shape:
+            raise ValueError('Mismatching param shapes')
+        self.weights = weights
+        self.bias = bias
+
+# Makes the pair model for the backend selected in the config
+def make_model(batch_size: int = 64, learning_rate: float = LEARNING_RATE) -> Model:
+    if config['rec_backend'] == 'tensorflow':
+        import tf_model
+        return tf_model.Model(PROFILE_SIZE, len(rating_choices), batch_size, learning_rate)
+    elif config['rec_backend'] == 'numpy':
+        return NumPyModel(PROFILE_SIZE, len(rating_choices), batch_size, learning_rate)
+    else:
+        raise ValueError(f'Unrecognized rec_backend: {config["rec_backend"]}')
+
+
+def fetch_user_profiles(ids: List[str]) -> Mapping[str, np.ndarray]:
+    docs = db.get_user_profiles(ids)
+    return { id: np.array(docs[id]['vals']) for id in docs }
+
+def store_user_profiles(items: List[Tuple[str, np.ndarray]]) -> None:
+    db.put_user_profiles([ (id, {'vals': vals.tolist()}) for id, vals in items ])
+
+def fetch_item_profiles(ids: List[str]) -> Mapping[str, np.ndarray]:
+    docs = db.get_item_profiles(ids)
+    return { id: np.array(docs[id]['vals']) for id in docs }
+
+def store_item_profiles(items: List[Tuple[str, np.ndarray]]) -> None:
+    db.put_item_profiles([ (id, {'vals': vals.tolist()}) for id, vals in items ])
+
+
+# The recommender engine.
+# Its state (the model, the aioff rating counters, and the banned addresses) is one database document,
+# which the write-behind flusher writes back like a modified cache item, so a crash loses only recent training.
 class Engine:
     def __init__(self) -> None:
-        self.model = Model()
-        self.user_profiles: cache.Cache[str,np.ndarray] = cache.Cache(500, fetch_user_profile, store_user_profile)
-        self.item_profiles: cache.Cache[str,np.ndarray] = cache.Cache(500, fetch_item_profile, store_item_profile)
+        self.model = make_model()
+        profile_dir = cast(str, config['profile_dir'])
+        self.user_profiles = ProfileTable(PROFILE_SIZE, 'user_profiles', fetch_user_profiles, store_user_profiles, os.path.join(profile_dir, 'user_profiles') if len(profile_dir) > 0 else '')
+        self.item_profiles = ProfileTable(PROFILE_SIZE, 'item_profiles', fetch_item_profiles, store_item_profiles, os.path.join(profile_dir, 'item_profiles') if len(profile_dir) > 0 else '')
+        self.item_indexes: Dict[str, ItemIndex] = {} # Maps the id of a post to an index of its children
 
         # Buffers for batch training
         self.account_samplers = [ '' for i in range(12) ]
@@ -103,6 +194,18 @@ class Engine:
 
         self.banned_addresses: Set[str] = set()
 
+        # The published model version. Callers compare it to tell when anything they derived from predictions is stale.
+        # Training and rating change predictions all the time, so changes are only published every publish_interval seconds
+        # (and a model is published right away when it is loaded).
+        self.version = 0
+        self.publish_interval = cast(float, config['rec_publish_interval'])
+        self.published_time = time.monotonic() # (Not saved.)
+        self.unpublished = False # True iff predictions have changed since the version was published (Not saved.)
+
+        self.modified_time: Optional[float] = None # When the state was first modified since it was last written (Not saved.)
+        self.write_backs = 0
+        cache.all_caches.append(self)
+
     def marshal(self) -> Mapping[str, Any]:
         return {
                 'model': self.model.marshal(),
@@ -118,6 +221,55 @@ class Engine:
         rating_freq = ob['rating_freq']
         rating_count = ob['rating_count']
         self.banned_addresses = set(ob['banned_addrs'])
+        self.version += 1
+        self.published_time = time.monotonic()
+        self.unpublished = False
+
+    # Returns the published model version, publishing the current one first if changes have waited long enough
+    def published_version(self) -> int:
+        if self.unpublished and time.monotonic() - self.published_time >= self.publish_interval:
+            self.version += 1
+            self.published_time = time.monotonic()
+            self.unpublished = False
+        return self.version
+
+    # Flags the engine state to be written back to the database
+    def set_modified(self) -> None:
+        if self.modified_time is None:
+            self.modified_time = time.monotonic()
+
+    # Writes the engine state to the database if it was first modified before the specified time.
+    # Returns the number of documents written (0 or 1).
+    def write_back(self, max_count: int, modified_before: float) -> int:
+        if self.modified_time is None or max_count < 1 or self.modified_time >= modified_before:
+            return 0
+        db.put_engine(self.marshal())
+        self.modified_time = None
+        self.write_backs += 1
+        return 1
+
+    def flush(self) -> None:
+        self.write_back(1, float('inf'))
+
+    # Returns counters in the same form as cache.Cache.stats
+    def stats(self) -> Mapping[str, Any]:
+        return {
+            'name': 'engine',
+            'policy': 'none',
+            'size': 1,
+            'max_size': 1,
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'write_backs': self.write_backs,
+            'hit_rate': 0.,
+        }
+
+    # Refuses further requests from an address
+    def ban(self, addr: str) -> None:
+        if not addr in self.banned_addresses:
+            self.banned_addresses.add(addr)
+            self.set_modified()
 
     def rate(self, user_id: str, item_id: str, rating: List[float]) -> None:
         # Update the aioff rating counters for this post
@@ -146,77 +298,101 @@ class Engine:
         db.put_rating(user_id, item_id, rating)
 
         # Ensure profiles exist for the user and item
-        try:
-            self.user_profiles[user_id]
-        except KeyError:
-            self.user_profiles.add(user_id, np.random.normal(0., 0.01, PROFILE_SIZE))
-        try:
-            self.item_profiles[item_id]
-        except KeyError:
-            self.item_profiles.add(item_id, np.random.normal(0., 0.01, PROFILE_SIZE))
+        Engine.ensure_profiles(self.user_profiles, [ user_id ])
+        Engine.ensure_profiles(self.item_profiles, [ item_id ])
         accounts.account_cache.set_modified(user_id)
         posts.post_cache.set_modified(item_id)
+        self.unpublished = True
+        self.set_modified()
 
         # Do a little training
-        for i in range(5):
-            self.train()
+        if trainer is not None:
+            trainer.submit((user_id, item_id, rating))
+        else:
+            for i in range(cast(int, config['train_steps_per_rating'])):
+                self.train((user_id, item_id, rating) if i == 0 else None)
+
+    # Returns a (len(item_ids), len(rating_choices)) matrix of ratings for the specified items.
+    # If this account has previously rated an item, its row holds those ratings instead.
+    # If there is no profile for an item (because no one has ever rated it), its row is all NaN.
+    def get_ratings(self, user_id: str, item_ids: List[str]) -> np.ndarray:
+        results = np.full([len(item_ids), len(rating_choices)], np.nan, dtype=np.float32)
 
-    # Returns ratings for the specified list of item_ids.
-    # If this account has previously rated the item, returns those ratings instead.
-    # If there is no profile for the item (because no one has ever rated it), returns [].
-    def get_ratings(self, user_id: str, item_ids: List[str]) -> List[List[float]]:
         # Get the ratings for the items this user previously rated
         prior_ratings = db.get_ratings_for_rated_items(user_id, item_ids)
-
-        # Predict ratings for all the items this user has never rated
-        rated = [ (item_id in prior_ratings) for item_id in item_ids ] # List of bools. True iff this account has rated the item
-        unrated = [ item_ids[i] for i in range(len(rated)) if not rated[i] ] # List of item ids that need rating
-        try:
-            user_prof = self.user_profiles[user_id]
-            can_be_rated: List[bool] = []
-            item_profs: List[np.ndarray] = []
-            for i in range(len(unrated)):
-                try:
-                    item_prof = self.item_profiles[unrated[i]]
-                    can_be_rated.append(True)
-                    item_profs.append(item_prof)
-                except KeyError:
-                    can_be_rated.append(False)
-            user_profs = [ user_prof for _ in item_profs ]
-            ratings = self.predict(user_profs, item_profs)
-        except KeyError:
-            can_be_rated = [ False for _ in unrated ]
-            ratings = []
-
-        # Combine the results
-        j = 0
-        k = 0
-        results: List[List[float]] = []
+        unrated: List[int] = [] # Indexes of the items that need rating
         for i in range(len(item_ids)):
-            if rated[i]:
-                results.append(prior_ratings[item_ids[i]]) # previously rated by this user
+            if item_ids[i] in prior_ratings:
+                results[i] = prior_ratings[item_ids[i]]
             else:
-                if can_be_rated[j]:
-                    results.append(ratings[k]) # predicted
-                    k += 1
-                else:
-                    results.append([]) # no data
-                j += 1
+                unrated.append(i)
+        if len(unrated) == 0:
+            return results
+
+        # Predict ratings for all the items this user has never rated
+        user_row = self.user_profiles.find(user_id)
+        if user_row < 0:
+            return results
+        item_rows = self.item_profiles.find_many([ item_ids[i] for i in unrated ])
+        found = item_rows >= 0
+        can_be_rated = np.array(unrated)[found]
+        if len(can_be_rated) > 0:
+            item_profs = self.item_profiles.gather(item_rows[found])
+            results[can_be_rated] = self.predict(np.broadcast_to(self.user_profiles.gather(np.array([ user_row ])), item_profs.shape), item_profs)
         return results
 
-    # Performs one batch of training on the pair model
-    def train(self) -> None:
+    # Returns up to k of the specified items, in the order this user should see them.
+    # Items no one has rated yet come first (newest first), like the feed scores them.
+    # The rest are ranked by the predicted score (the sum of the ratings weighted by the sign of each choice),
+    # which is linear in the item profile, so it is a dot product with a query vector made from the user profile.
+    # Users with no profile yet (and any slots the search leaves empty) get the newest rated items.
+    # The items are indexed under index_key (such as the id of their parent post), and the index is updated as the list grows.
+    def recommend(self, user_id: str, index_key: str, item_ids: List[str], k: int) -> List[str]:
+        index = self.item_indexes.get(index_key)
+        if index is None:
+            index = ItemIndex(self.item_profiles, cast(int, config['rec_exact_max']), cast(int, config['rec_ivf_probes']))
+            self.item_indexes[index_key] = index
+        index.update(item_ids)
+        picks = [ item_ids[pos] for pos in reversed(index.unprofiled[-k:]) ] if k > 0 else []
+        user_row = self.user_profiles.find(user_id)
+        if len(picks) < k and user_row >= 0:
+            weights, _ = self.model.get_common_layer()
+            query = self.user_profiles.gather(np.array([ user_row ]))[0] * np.matmul(weights, rating_signs.astype(np.float32))
+            picks += [ item_ids[pos] for pos in index.search(query, k - len(picks)) ]
+        if len(picks) < k:
+            chosen = set(picks)
+            newest = index.profiled[top_positions(index.profiled, min(len(index.profiled), 2 * k))]
+            picks += [ id for id in [ item_ids[pos] for pos in newest.tolist() ] if not id in chosen ][:k - len(picks)]
+        return picks
+
+    # Returns the row for each id, adding a small random profile for ids that do not have one yet
+    @staticmethod
+    def ensure_profiles(profiles: ProfileTable, ids: List[str]) -> np.ndarray:
+        rows = profiles.find_many(ids)
+        for i in np.flatnonzero(rows < 0).tolist():
+            rows[i] = profiles.rows.get(ids[i], -1) # (in case the same id appeared earlier in the list)
+            if rows[i] < 0:
+                rows[i] = profiles.add(ids[i], np.random.normal(0., 0.01, PROFILE_SIZE))
+        return rows
+
+    # Performs one batch of training on the pair model.
+    # If a fresh rating is given, it is included in the batch.
+    def train(self, fresh: Optional[Tuple[str, str, List[float]]] = None) -> None:
         # Make a batch
         samples = db.get_random_ratings(self.batch_users.shape[0])
+        if len(samples) == 0:
+            return # No ratings yet
         if len(samples) < self.batch_users.shape[0]:
             print(f'Skipping training because there were only {len(samples)} samples')
             return
+        if fresh is not None:
+            samples[0] = fresh
         assert len(samples) == self.batch_users.shape[0], 'too many samples'
-        for i in range(len(samples)):
-            sample = samples[i]
-            self.batch_users[i] = self.user_profiles[sample[0]]
-            self.batch_items[i] = self.item_profiles[sample[1]]
-            self.batch_ratings[i] = sample[2]
+        user_rows = Engine.ensure_profiles(self.user_profiles, [ sample[0] for sample in samples ])
+        item_rows = Engine.ensure_profiles(self.item_profiles, [ sample[1] for sample in samples ])
+        self.batch_users[:] = self.user_profiles.gather(user_rows)
+        self.batch_items[:] = self.item_profiles.gather(item_rows)
+        self.batch_ratings[:] = [ sample[2] for sample in samples ]
 
         # Refine
         self.model.set_users(self.batch_users)
@@ -224,48 +400,79 @@ class Engine:
         self.model.refine(self.batch_ratings)
 
         # Store changes
-        updated_users = self.model.batch_user.numpy()
-        updated_items = self.model.batch_item.numpy()
-        for i in range(len(samples)):
-            sample = samples[i]
-            self.user_profiles[sample[0]] = updated_users[i]
-            self.item_profiles[sample[1]] = updated_items[i]
-
-    # Assumes the profiles for the users and items already exist
-    def predict(self, users:List[np.ndarray], items:List[np.ndarray]) -> List[List[float]]:
-        assert len(users) == len(items), 'Expected lists to have same size'
-        results: List[List[float]] = []
-        if len(users) == 0:
-            return results
-        for i in range(len(users)):
-            j = i % self.batch_users.shape[0]
-            if j == 0 and i > 0:
-                # Predict a batch
-                self.model.set_users(self.batch_users)
-                self.model.set_items(self.batch_items)
-                pred = self.model.act().numpy()
-
-                # Gather results
-                for k in range(pred.shape[0]):
-                    ratings = pred[k].tolist()
-                    results.append(ratings)
-
-            # Add to the batch
-            self.batch_users[j] = users[i]
-            self.batch_items[j] = items[i]
-
-        # Predict the final batch
-        self.model.set_users(self.batch_users)
-        self.model.set_items(self.batch_items)
-        pred = self.model.act().numpy()
-
-        # Gather results
-        remainder = len(users) % self.batch_users.shape[0]
-        if remainder == 0:
-            remainder = self.batch_users.shape[0]
-        for k in range(remainder):
-            ratings = pred[k].tolist()
-            results.append(ratings)
-        return results
+        self.user_profiles.scatter(user_rows, self.model.get_users())
+        self.item_profiles.scatter(item_rows, self.model.get_items())
+        self.unpublished = True
+        self.set_modified()
+
+    # Consumes (n, PROFILE_SIZE) matrices of user and item profiles
+    # Returns an (n, len(rating_choices)) matrix of predicted ratings
+    def predict(self, users: np.ndarray, items: np.ndarray) -> np.ndarray:
+        assert users.shape == items.shape, 'Expected matrices to have same shape'
+        return self.model.predict_many(users, items)
 
 engine = Engine()
+
+# A thread that trains the recommender in the background, so rating a post does not wait for training.
+# Each new rating buys a few batches of training (which include that rating).
+# If train_interval is positive, it also trains on random ratings whenever it has been idle that long.
+class Trainer(threading.Thread):
+    def __init__(self, steps_per_rating: int, interval: float, max_queue: int) -> None:
+        threading.Thread.__init__(self, daemon=True)
+        self.steps_per_rating = steps_per_rating
+        self.interval = interval
+        self.queue: queue.Queue[Optional[Tuple[str, str, List[float]]]] = queue.Queue(max_queue)
+        self.dropped = 0
+
+    # Queues a new rating for training. Never blocks.
+    def submit(self, rating: Tuple[str, str, List[float]]) -> None:
+        try:
+            self.queue.put_nowait(rating)
+        except queue.Full:
+            self.dropped += 1 # (The rating is still in the database, so it will be sampled eventually)
+
+    def run(self) -> None:
+        while True:
+            try:
+                rating = self.queue.get(timeout=(self.interval if self.interval > 0. else None))
+            except queue.Empty:
+                self.step(None)
+                continue
+            if rating is None:
+                break # stop was called
+            for i in range(self.steps_per_rating):
+                self.step(rating if i == 0 else None)
+
+    # Trains one batch. Holding the lock while the batch is refined and the profiles are put back
+    # means requests see the model either entirely before or entirely after each step.
+    def step(self, fresh: Optional[Tuple[str, str, List[float]]]) -> None:
+        try:
+            with cache.lock:
+                engine.train(fresh)
+        except Exception:
+            traceback.print_exc()
+
+    # Finishes training on the queued ratings, then stops the thread
+    def stop(self) -> None:
+        self.queue.put(None)
+        self.join()
+
+trainer: Optional[Trainer] = None
+
+def start_trainer() -> None:
+    global trainer
+    if cast(bool, config['train_in_background']):
+        trainer = Trainer(
+            cast(int, config['train_steps_per_rating']),
+            cast(float, config['train_interval']),
+            cast(int, config['train_max_queue']),
+        )
+        trainer.start()
+
+def stop_trainer() -> None:
+    global trainer
+    if trainer is not None:
+        trainer.stop()
+        if trainer.dropped > 0:
+            print(f'The trainer dropped {trainer.dropped} ratings because it could not keep up')
+        trainer = None
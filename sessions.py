@@ -42,12 +42,13 @@ class Session():
             self.active_index = len(self.account_ids)
             self.account_ids.append(no_password_account.id)
             no_password_account.session_id = self.id
+            accounts.account_cache.set_modified(no_password_account.id)
         else:
             acc = accounts.find_account_by_name(account_name)
             if acc.password != password:
                 raise ValueError('Incorrect password')
             if acc.banned:
-                rec.engine.banned_addresses.add(self.addr)
+                rec.engine.ban(self.addr)
                 raise ValueError('Log in to banned account')
             if acc.id in self.account_ids:
                 self.active_index = self.account_ids.index(acc.id)
@@ -55,6 +56,7 @@ class Session():
                 self.active_index = len(self.account_ids)
                 self.account_ids.append(acc.id)
                 acc.session_id = self.id
+                accounts.account_cache.set_modified(acc.id)
 
     def marshal(self) -> Mapping[str, Any]:
         return {
@@ -80,7 +82,7 @@ def store_session(id: str, sess: Session) -> None:
     assert id == sess.id, 'mismatching ids'
     db.put_session(id, sess.marshal())
 
-session_cache: cache.Cache[str,Session] = cache.Cache(300, fetch_session, store_session)
+session_cache: cache.Cache[str,Session] = cache.Cache(300, fetch_session, store_session, 'sessions')
 
 
 def get_or_make_session(session_id: str, ip_address: str) -> Session:
@@ -90,14 +92,15 @@ def get_or_make_session(session_id: str, ip_address: str) -> Session:
     try:
         session = session_cache[session_id]
         if session.banned:
-            rec.engine.banned_addresses.add(ip_address)
+            rec.engine.ban(ip_address)
             raise ValueError('Banned session')
     except KeyError:
         account = accounts.make_starter_account()
         session = Session(session_id, [ account.id ], 0)
         session_cache.add(session_id, session)
-    if len(ip_address) > 0:
+    if len(ip_address) > 0 and session.addr != ip_address:
         session.addr = ip_address
+        session_cache.set_modified(session_id)
     return session
 
 # Make a session in advance for the next client who will need a new session
@@ -0,0 +1,61 @@
+from typing import Mapping, Any, Tuple, cast
+import numpy as np
+import tensorflow as tf
+import nn
+import rec
+
+# The TensorFlow implementation of the pair model.
+# (This module is only imported if config['rec_backend'] is 'tensorflow', so TensorFlow is not loaded otherwise.)
+class Model(rec.Model):
+    def __init__(self, profile_size: int, rating_size: int, batch_size: int = 64, learning_rate: float = rec.LEARNING_RATE) -> None:
+        self.batch_size = batch_size
+        self.batch_user = tf.Variable(np.zeros([self.batch_size, profile_size]), dtype = tf.float32)
+        self.batch_item = tf.Variable(np.zeros([self.batch_size, profile_size]), dtype = tf.float32)
+        self.common_layer = nn.LayerLinear(profile_size, rating_size)
+        self.optimizer = tf.keras.optimizers.SGD(learning_rate = learning_rate)
+        self.params = self.common_layer.params
+
+    def set_users(self, user_profiles: np.ndarray) -> None:
+        self.batch_user.assign(user_profiles)
+
+    def set_items(self, item_profiles: np.ndarray) -> None:
+        self.batch_item.assign(item_profiles)
+
+    def get_users(self) -> np.ndarray:
+        return cast(np.ndarray, self.batch_user.numpy())
+
+    def get_items(self) -> np.ndarray:
+        return cast(np.ndarray, self.batch_item.numpy())
+
+    def act(self) -> tf.Tensor:
+        common = self.common_layer.act(self.batch_user * self.batch_item)
+        return common
+
+    def predict(self) -> np.ndarray:
+        return cast(np.ndarray, self.act().numpy())
+
+    def predict_many(self, users: np.ndarray, items: np.ndarray) -> np.ndarray:
+        return cast(np.ndarray, self.common_layer.act(tf.constant(users * items, dtype = tf.float32)).numpy())
+
+    def cost(self, targ: tf.Tensor, pred: tf.Tensor) -> tf.Tensor:
+        return tf.reduce_mean(tf.reduce_sum(tf.square(targ - pred), axis = 1), axis = 0)
+
+    def refine(self, y: np.ndarray) -> None:
+        with tf.GradientTape() as tape:
+            cost = self.cost(y, self.act())
+        self.optimizer.apply_gradients(zip(tape.gradient(cost, self.params), self.params))
+
+    def get_common_layer(self) -> Tuple[np.ndarray, np.ndarray]:
+        return self.common_layer.weights.numpy(), self.common_layer.bias.numpy()
+
+    def marshal(self) -> Mapping[str, Any]:
+        return {
+                "params": [ p.numpy().tolist() for p in self.params ],
+            }
+
+    def unmarshal(self, ob: Mapping[str, Any]) -> None:
+        params = ob['params']
+        if len(params) != len(self.params):
+            raise ValueError('Mismatching number of params')
+        for i in range(len(params)):
+            self.params[i].assign(np.array(params[i]))
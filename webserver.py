@@ -1,5 +1,12 @@
-from typing import Mapping, Any, Dict, Callable, cast, Optional
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Mapping, Any, Dict, Callable, cast, Optional, Tuple, List, Union
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from email.message import Message
+import contextvars
+import io
+import gzip
+import hashlib
+import threading
+import email.utils
 import webbrowser
 import os
 import json
@@ -10,35 +17,228 @@ import re
 import posixpath
 from datetime import datetime, timedelta
 import sessions
+import cache
+from config import config
+from indexable_dict import IndexableDict
 
 
-sws: 'SimpleWebServer'
+# Serves one request at a time
+class SingleThreadedServer(HTTPServer):
+    request_queue_size = 128
+
+# Serves each connection on its own thread.
+# Page handlers are serialized by cache.lock, but socket I/O, uploads, and static files proceed concurrently.
+class MultiThreadedServer(ThreadingHTTPServer):
+    request_queue_size = 128
+    daemon_threads = True
+
+# Exposes the parts of the HTTP request that page handlers may need.
+# Each request gets its own context, so handlers running on different threads do not interfere.
+class RequestContext():
+    def __init__(self, rfile: io.BufferedIOBase, headers: Message, client_address: Tuple[str, int]) -> None:
+        self.rfile = rfile
+        self.headers = headers
+        self.client_address = client_address
+
+    # Returns the filename specified for the file
+    def receive_file(self, save_as_name: str, max_size: int) -> str:
+        content_type = self.headers['content-type']
+        if not content_type:
+            assert False, "No content-type header"
+        boundary = content_type.split("=")[1].encode()
+        # print(f'boundary={boundary}')
+        remainbytes = int(self.headers['content-length'])
+        # print(f'packet size={remainbytes}')
+        assert remainbytes <= max_size, 'File too big'
+        assert remainbytes > 0, 'Empty file packet'
+        line = self.rfile.readline()
+        remainbytes -= len(line)
+        if not boundary in line:
+            assert False, "expected content to begin with boundary"
+        line = self.rfile.readline()
+        remainbytes -= len(line)
+        fn = re.findall(r'Content-Disposition.*name="file"; filename="(.*)"', line.decode()) or ['']
+
+        # Skip b'Content-Type: image/jpeg\r\n'
+        line = self.rfile.readline()
+        remainbytes -= len(line)
+        # print(f'discard_line_1={line}') # type: ignore
+
+        # Skip b'\r\n'
+        line = self.rfile.readline()
+        remainbytes -= len(line)
+        print(f'discard_line_2={line}') # type: ignore
+
+        # Read the file
+        assert remainbytes > 0, 'Empty file'
+        with open(save_as_name, 'wb') as out:
+            preline = self.rfile.readline()
+            remainbytes -= len(preline)
+            while remainbytes > 0:
+                line = self.rfile.readline()
+                remainbytes -= len(line)
+                if boundary in line:
+                    preline = preline[0:-1]
+                    if preline.endswith(b'\r'):
+                        preline = preline[0:-1]
+                    out.write(preline)
+                    out.close()
+                    break
+                else:
+                    out.write(preline)
+                    preline = line
+        return str(fn[0])
+
+request_context: contextvars.ContextVar[RequestContext] = contextvars.ContextVar('request_context')
+
+# Returns the context of the request being handled by the current thread
+def current_request() -> RequestContext:
+    return request_context.get()
+
+mime_types = {
+    '.svg': 'image/svg+xml',
+    '.jpeg': 'image/jpeg',
+    '.jpg': 'image/jpeg',
+    '.png': 'image/png',
+    '.js': 'text/javascript',
+}
+
+def mime_type(filename: str) -> str:
+    name, ext = os.path.splitext(filename)
+    return mime_types[ext] if ext in mime_types else 'text/html'
+
+# Returns true iff the client already has the content identified by etag
+def client_has(headers: Message, etag: str, last_modified: Optional[str]) -> bool:
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        return if_none_match == '*' or etag in [ tag.strip() for tag in if_none_match.split(',') ]
+    return last_modified is not None and headers.get('If-Modified-Since') == last_modified
+
+# An in-memory copy of a file on disk, prepared for serving
+class StaticFile():
+    def __init__(self, filename: str, mtime: float, content: bytes) -> None:
+        self.mtime = mtime
+        self.mime_type = mime_type(filename)
+        self.content = content
+        self.etag = f'"{hashlib.md5(content).hexdigest()}"'
+        self.last_modified = email.utils.formatdate(mtime, usegmt=True)
+
+        # Images are already compressed, so only text is worth gzipping
+        self.gzipped: Optional[bytes] = None
+        if self.mime_type.startswith('text/') or self.mime_type == 'image/svg+xml':
+            gzipped = gzip.compress(content, 9)
+            if len(gzipped) < len(content):
+                self.gzipped = gzipped
+
+MAX_STATIC_FILES = 2000 # The max number of files to hold in memory
+MAX_STATIC_FILE_SIZE = 4000000 # Bigger files are read from disk every time
+static_files: IndexableDict[str, StaticFile] = IndexableDict()
+static_files_lock = threading.Lock()
+
+# Returns the specified file. Only reads from disk if the file is not cached or has been modified.
+# Raises OSError if the file cannot be read.
+def get_static_file(filename: str) -> StaticFile:
+    mtime = os.stat(filename).st_mtime
+    with static_files_lock:
+        if filename in static_files and static_files[filename].mtime == mtime:
+            return static_files[filename]
+    with open(filename, 'rb') as f:
+        content = f.read()
+    sf = StaticFile(filename, mtime, content)
+    if len(content) <= MAX_STATIC_FILE_SIZE:
+        with static_files_lock:
+            if not filename in static_files and len(static_files) >= MAX_STATIC_FILES:
+                static_files.drop(static_files.random_key())
+            static_files[filename] = sf
+    return sf
+
+# Maps the parts of each template to their digests, so page ETags only need to hash the parts that vary.
+# (Lookups are cheap because a bytes object caches its hash, and the dict checks identity before contents.)
+template_digests: Dict[bytes, bytes] = {}
+
+# Loads a page template and splits it at the '//<globals>//' marker.
+# Page handlers can then respond with [prefix, globals, suffix] without copying or re-encoding the template.
+def load_template(filename: str) -> Tuple[bytes, bytes]:
+    with open(filename, 'rb') as f:
+        template = f.read()
+    marker = b'//<globals>//'
+    pos = template.index(marker)
+    prefix, suffix = template[:pos], template[pos + len(marker):]
+    template_digests[prefix] = hashlib.md5(prefix).digest()
+    template_digests[suffix] = hashlib.md5(suffix).digest()
+    return prefix, suffix
+
+# Returns an ETag for a page made of chunks.
+# Template parts contribute their precomputed digests, so only the other chunks are hashed.
+def page_etag(chunks: List[bytes]) -> str:
+    hasher = hashlib.md5()
+    for chunk in chunks:
+        hasher.update(template_digests.get(chunk, chunk))
+    return f'"{hasher.hexdigest()}"'
+
+# Page handlers may return a str, bytes, or a list of byte chunks
+def to_chunks(content: Union[str, bytes, List[bytes]]) -> List[bytes]:
+    if isinstance(content, str):
+        return [ bytes(content, 'utf8') ]
+    elif isinstance(content, bytes):
+        return [ content ]
+    else:
+        return content
+
 simpleWebServerPages: Mapping[str, Any] = {}
 class SimpleWebServer(BaseHTTPRequestHandler):
-    def __init__(self, *args: Any) -> None:
-        self.mime_types: Dict[str, str] = {}
-        self.mime_types['.svg'] = 'image/svg+xml'
-        self.mime_types['.jpeg'] = 'image/jpeg'
-        self.mime_types['.jpg'] = 'image/jpeg'
-        self.mime_types['.png'] = 'image/png'
-        self.mime_types['.js'] = 'text/javascript'
-        BaseHTTPRequestHandler.__init__(self, *args)
-
-    def send_file(self, filename: str, content: str, session_id: str) -> None:
-        self.send_response(200)
-        name, ext = os.path.splitext(filename)
-        if ext in self.mime_types:
-            self.send_header('Content-type', self.mime_types[ext])
-        else:
-            self.send_header('Content-type', 'text/html')
+    def send_file(self, filename: str, content: Union[str, bytes, List[bytes]], session_id: str) -> None:
+        chunks = to_chunks(content)
+        etag = page_etag(chunks)
         expires = datetime.utcnow() + timedelta(days=720)
         s_expires = expires.strftime("%a, %d %b %Y %H:%M:%S GMT")
+        if client_has(self.headers, etag, None):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Set-Cookie', f'sid={session_id}; samesite=strict; Expires={s_expires}')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-type', mime_type(filename))
+        self.send_header('Content-Length', str(sum([ len(chunk) for chunk in chunks ])))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
         self.send_header('Set-Cookie', f'sid={session_id}; samesite=strict; Expires={s_expires}')
         self.end_headers()
-        if isinstance(content, str):
-            self.wfile.write(bytes(content, 'utf8'))
-        else:
-            self.wfile.write(content)
+        self.wfile.writelines(chunks)
+
+    # Sends a file from disk (or from memory if it has been served before).
+    # Supports conditional GET and gzip. No cookie is set, since static files are the same for everyone.
+    def send_static_file(self, filename: str) -> None:
+        try:
+            sf = get_static_file(filename)
+        except OSError:
+            blob = bytes(f'404 {filename} not found.\n', 'utf8')
+            self.send_response(404)
+            self.send_header('Content-type', 'text/html')
+            self.send_header('Content-Length', str(len(blob)))
+            self.end_headers()
+            self.wfile.write(blob)
+            return
+        if client_has(self.headers, sf.etag, sf.last_modified):
+            self.send_response(304)
+            self.send_header('ETag', sf.etag)
+            self.end_headers()
+            return
+        content = sf.content
+        self.send_response(200)
+        self.send_header('Content-type', sf.mime_type)
+        if sf.gzipped is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+            if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+                self.send_header('Content-Encoding', 'gzip')
+                content = sf.gzipped
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', sf.etag)
+        self.send_header('Last-Modified', sf.last_modified)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(content)
 
     def do_HEAD(self) -> None:
         self.send_response(200)
@@ -46,9 +246,7 @@ class SimpleWebServer(BaseHTTPRequestHandler):
         self.end_headers()
 
     def do_GET(self) -> None:
-        global sws
-        sws = self
-
+        request_context.set(RequestContext(self.rfile, self.headers, self.client_address))
         ip_address = self.client_address[0]
 
         # Parse url
@@ -57,6 +255,11 @@ class SimpleWebServer(BaseHTTPRequestHandler):
         if filename[0] == '/':
             filename = filename[1:]
 
+        # Static files do not need a session
+        if not filename in simpleWebServerPages:
+            self.send_static_file(filename)
+            return
+
         # Parse query
         q = urlparse.parse_qs(url_parts.query)
         q = { k:(q[k][0] if len(q[k]) == 1 else q[k]) for k in q } # type: ignore
@@ -71,23 +274,16 @@ class SimpleWebServer(BaseHTTPRequestHandler):
         else:
             session_id = sessions.new_session_id()
             print(f'No session id. Making new one.')
-        session = sessions.get_or_make_session(session_id, ip_address)
+        with cache.lock:
+            session = sessions.get_or_make_session(session_id, ip_address)
 
         # Get content
-        if filename in simpleWebServerPages:
+        with cache.lock:
             content = simpleWebServerPages[filename](q, session)
-        else:
-            try:
-                with open(filename, 'rb') as f:
-                    content = f.read()
-            except:
-                content = f'404 {filename} not found.\n'
         self.send_file(filename, content, session_id)
 
     def do_POST(self) -> None:
-        global sws
-        sws = self
-
+        request_context.set(RequestContext(self.rfile, self.headers, self.client_address))
         ip_address = self.client_address[0]
 
         # Parse url
@@ -109,25 +305,28 @@ class SimpleWebServer(BaseHTTPRequestHandler):
                 session_id = cookie['sid'].value
             else:
                 raise ValueError('No cookie in POST with uploaded file.')
-        session = sessions.get_or_make_session(session_id, ip_address)
+        with cache.lock:
+            session = sessions.get_or_make_session(session_id, ip_address)
 
         upload_file_type = 'multipart/form-data'
         if filename == 'receive_image.html':
+            # (This handler acquires cache.lock itself, so other requests are not blocked while the image uploads)
             response = simpleWebServerPages[filename]({}, session)
             ajax_params = {}
             self.send_response(200)
             self.send_header('Content-type', 'text/html')
             self.end_headers()
-            self.wfile.write(bytes(response, 'utf8'))
+            self.wfile.writelines(to_chunks(response))
         elif self.headers.get('Content-Type')[:len(upload_file_type)] == upload_file_type:
             act = self.headers.get('Act') # An action specifying what to do with this image
             t = datetime.now()
             fn = f'{session_id}_{t.year:04}-{t.month:02}-{t.day:02}_{t.hour:02}-{t.minute:02}-{t.second:02}-{t.microsecond:06}.jpeg'
-            self.receive_file(f'/tmp/{fn}', 16000000)
-            response = simpleWebServerPages[filename]({
-                'act': act,
-                'file': fn,
-            }, session)
+            current_request().receive_file(f'/tmp/{fn}', 16000000)
+            with cache.lock:
+                response = simpleWebServerPages[filename]({
+                    'act': act,
+                    'file': fn,
+                }, session)
             self.send_response(200)
             self.send_header("Content-type", "application/json")
             self.end_headers()
@@ -139,67 +338,26 @@ class SimpleWebServer(BaseHTTPRequestHandler):
             ajax_params = json.loads(post_body)
 
             # Generate a response
-            response = simpleWebServerPages[filename](ajax_params, session)
+            with cache.lock:
+                response = simpleWebServerPages[filename](ajax_params, session)
             self.send_response(200)
             self.send_header("Content-type", "application/json")
             self.end_headers()
             self.wfile.write(bytes(json.dumps(response), 'utf8'))
 
-    # Returns the filename specified for the file
-    def receive_file(self, save_as_name: str, max_size: int) -> str:
-        content_type = self.headers['content-type']
-        if not content_type:
-            assert False, "No content-type header"
-        boundary = content_type.split("=")[1].encode()
-        # print(f'boundary={boundary}')
-        remainbytes = int(self.headers['content-length'])
-        # print(f'packet size={remainbytes}')
-        assert remainbytes <= max_size, 'File too big'
-        assert remainbytes > 0, 'Empty file packet'
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        if not boundary in line:
-            assert False, "expected content to begin with boundary"
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        fn = re.findall(r'Content-Disposition.*name="file"; filename="(.*)"', line.decode()) or ['']
-
-        # Skip b'Content-Type: image/jpeg\r\n'
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        # print(f'discard_line_1={line}') # type: ignore
-
-        # Skip b'\r\n'
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        print(f'discard_line_2={line}') # type: ignore
-
-        # Read the file
-        assert remainbytes > 0, 'Empty file'
-        with open(save_as_name, 'wb') as out:
-            preline = self.rfile.readline()
-            remainbytes -= len(preline)
-            while remainbytes > 0:
-                line = self.rfile.readline()
-                remainbytes -= len(line)
-                if boundary in line:
-                    preline = preline[0:-1]
-                    if preline.endswith(b'\r'):
-                        preline = preline[0:-1]
-                    out.write(preline)
-                    out.close()
-                    break
-                else:
-                    out.write(preline)
-                    preline = line
-        return str(fn[0])
-
     @staticmethod
     def render(pages: Mapping[str, Callable[[Mapping[str,Any], sessions.Session],Any]]) -> None:
         global simpleWebServerPages
         simpleWebServerPages = pages
-        port = 8986
-        httpd = HTTPServer(('', port), SimpleWebServer)
+        port = cast(int, config['port'])
+        mode = config['server_mode']
+        httpd: HTTPServer
+        if mode == 'single':
+            httpd = SingleThreadedServer(('', port), SimpleWebServer)
+        elif mode == 'threaded':
+            httpd = MultiThreadedServer(('', port), SimpleWebServer)
+        else:
+            raise ValueError(f'Unrecognized server_mode: {mode}')
         webbrowser.open(f'http://localhost:{port}/index.html', new=2)
         print('Press Ctrl-C to shut down again')
         try: